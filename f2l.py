@@ -4,20 +4,68 @@
 import optparse
 
 # system command functionality
-from subprocess import call
+from subprocess import call, Popen, PIPE
 
 # metadata read & write
 import mutagen
+import mutagen.flac
+import mutagen.mp4
 
 # image thumbnails
 from PIL import Image
 
+# fast directory listing (optional, os.scandir backport for python 2)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# in-process replaygain analysis (optional, see -g)
+try:
+    import numpy
+    from scipy.signal import lfilter
+except ImportError:
+    numpy = None
+
+# filesystem events for watch mode (optional, see -w)
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 # standard libs
 import os
+import shlex
+import shutil
+import tempfile
 import unicodedata
 import string
 import sys
 import base64
+import csv
+import fcntl
+import hashlib
+import multiprocessing
+import heapq
+import itertools
+import json
+import math
+import struct
+import sqlite3
+import stat
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+import httplib
+import socket
+import xmlrpclib
 
 imsize = 240, 240
 
@@ -25,6 +73,84 @@ validFilenameChars = "-_.!()[]{}&~+^ %s%s%s" % (string.ascii_letters, string.dig
 keepTags = {"album", "replaygain_album_gain", "title", "metadata_block_picture", "artist",
             "album artist", "date", "replaygain_track_gain", "genre", "tracknumber",
             "replaygain_track_peak", "replaygain_reference_loudness", "replaygain_album_peak"}
+# Flac tags kept in a FlacTrack: the copied ones, plus those desiredTags maps for m4a
+trackTags = keepTags | {"composer"}
+
+# ReplayGain 1.0 equal loudness filters (yulewalk, butter) per sample rate, from gain_analysis.c
+rg_filters = {
+    48000: (([0.03857599435200, -0.02160367184185, -0.00123395316851, -0.00009291677959, -0.01655260341619,
+              0.02161526843274, -0.02074045215285, 0.00594298065125, 0.00306428023191, 0.00012025322027,
+              0.00288463683916],
+             [1.0, -3.84664617118067, 7.81501653005538, -11.34170355132042, 13.05504219327545,
+              -12.28759895145294, 9.48293806319790, -5.87257861775999, 2.75465861874613, -0.86984376593551,
+              0.13919314567432]),
+            ([0.98621192462708, -1.97242384925416, 0.98621192462708],
+             [1.0, -1.97223372919527, 0.97261396931306])),
+    44100: (([0.05418656406430, -0.02911007808948, -0.00848709379851, -0.00851165645469, -0.00834990904936,
+              0.02245293253339, -0.02596338512915, 0.01624864962975, -0.00240879051584, 0.00674613682247,
+              -0.00187763777362],
+             [1.0, -3.47845948550071, 6.36317777566148, -8.54751527471874, 9.47693607801280,
+              -8.81498681370155, 6.85401540936998, -4.39470996079559, 2.19611684890774, -0.75104302451432,
+              0.13149317958808]),
+            ([0.98500175787242, -1.97000351574484, 0.98500175787242],
+             [1.0, -1.96977855582618, 0.97022847566350])),
+}
+rg_steps_per_db = 100
+rg_max_db = 120
+rg_pink_ref = 64.82
+
+# Kernel buffer for the decoder and encoder pipes, set with fcntl on Linux
+pipe_size = 1 << 20
+F_SETPIPE_SZ = 1031
+
+# Worker pool for transcode jobs, created by start_pool when -j > 1
+_pool = None
+_pool_slots = None
+# Jobs waiting for a worker, as a heap of (-cost, sequence, function, args), see submit_job
+_pool_queue = []
+_pool_lock = threading.Lock()
+_pool_seq = itertools.count()
+
+# Thread pool for updating the tags and art of existing lossy files, created by start_tag_pool
+_tag_pool = None
+_tag_limit = 0
+_tag_pending = 0
+_tag_cond = threading.Condition()
+
+# Job server of a coordinator run (-q), see JobServer
+_jobserver = None
+# Seconds a worker has to renew the lease on a job before it is handed out again
+job_lease = 120
+# Longest wait in seconds between a worker's attempts to reach a coordinator that isn't up yet
+connect_backoff = 30
+# Load and memory aware limit on the transcodes run at once, and the runtime budget, see Governor
+_governor = None
+# Memory to leave free for each transcode the governor lets start, in bytes
+job_memory = 128 << 20
+
+# What a worker sees when the coordinator can't be reached
+rpc_errors = (socket.error, httplib.HTTPException, xmlrpclib.Error)
+_print_lock = threading.Lock()
+
+# Sync manifest kept in each lossy root, see SyncManifest
+manifest_name = '.f2l_manifest.db'
+manifest_version = 5
+
+# Resized album art cache shared by all runs, opened by open_art_cache
+_art_cache = None
+
+# Cached listings of the flac and lossy trees, see TreeScan
+_tree = None
+# Checks and reads of the flac folders coming up in the walk, see ReadAhead
+_reader = None
+
+# Per-stage timings for the run report and progress line, created by start_stats
+_stats = None
+stat_fields = ('calls', 'wall', 'cpu', 'bytes_read', 'bytes_written', 'audio_seconds')
+
+# Jobs found by the run for the dry run output and plan file, created by start_plan
+_plan = None
+plan_kinds = ('replaygain', 'transcode', 'relocate', 'retag', 'art', 'purge')
 
 
 def removeDisallowedFilenameChars(filename):
@@ -35,7 +161,7 @@ def removeDisallowedFilenameChars(filename):
     try:
         filename = unicode(filename, encoding='utf-8')
     except UnicodeDecodeError:
-        print "Error converting %s to unicode.  Skipping bad characters..." % filename
+        print_lines(sys.stdout, "Error converting %s to unicode.  Skipping bad characters..." % filename)
         filename = unicode(filename, encoding='utf-8', errors='ignore')
        
     cleanedFilename = unicodedata.normalize('NFKD', filename).encode('ASCII', 'ignore')
@@ -61,33 +187,415 @@ def getTracknumberStr(mf, format):
         return "%02d" % tmp[0][0]
 
 
+def desiredTags(ft, lossyt, format):
+    """ Works out the tags lossyt should have, based on the tags in ft.
+    :param FlacTrack ft: FLAC file tag structure to copy
+    :param mutagen.File lossyt: lossy output file to tag
+    :param str format: 'ogg' or 'm4a'
+    :return dict: tag to list of values, in the lossy file's own keys
+    """
+    if format == 'ogg':
+        tags = {k: v for k, v in ft.tags.items() if k in keepTags}
+        # Art comes from folder.jpg, so keep what's embedded unless the flac has its own
+        if 'metadata_block_picture' not in tags and 'metadata_block_picture' in lossyt:
+            tags['metadata_block_picture'] = lossyt['metadata_block_picture']
+        return tags
+
+    elif format == 'm4a':
+        # We have to explicitly define how each tag is converted.  Sigh.
+        tags = {
+            '\xa9nam': ft.get('title', [u'']),
+            '\xa9ART': ft.get('artist', [u'']),
+            '\xa9alb': ft.get('album', [u'']),
+            '\xa9day': ft.get('date', [u'']),
+            'trkn': [(int(getTracknumberStr(ft, 'flac')), 0)],  # Don't bother with totaltracks
+            '\xa9gen': ft.get('genre', [u'']),
+            # if ft.get('album artist') == [u'Various Artists']:
+            #     'cpil': True
+            'aART': ft.get('album artist', [u'']),
+            '\xa9wrt': ft.get('composer', [u'']),
+        }
+        if 'replaygain_album_gain' in ft.keys():
+            tags['----:com.apple.iTunes:replaygain_album_gain'] = [ft['replaygain_album_gain'][0].encode('ascii')]
+            tags['----:com.apple.iTunes:replaygain_track_gain'] = [ft['replaygain_track_gain'][0].encode('ascii')]
+        return tags
+
+
 def updateTags(ft, lossyt, format):
-    """ Updates the tags in lossyt based on the tags in ft.
-    :param mutagen.File ft: FLAC file tag structure to copy
+    """ Updates the tags in lossyt based on the tags in ft, leaving them alone if they already
+        match.
+    :param FlacTrack ft: FLAC file tag structure to copy
     :param mutagen.File lossyt: lossy output file to tag
     :param str format: 'ogg' or 'm4a'
+    :return bool: True if any tag was changed, so the file needs saving
     """
+    tags = desiredTags(ft, lossyt, format)
 
     if format == 'ogg':
-        flactags = {k: v for k, v in ft.tags.items() if k in keepTags}
+        current = {k: lossyt.tags[k] for k in lossyt.tags.keys()} if lossyt.tags is not None else {}
+        if current == tags:
+            return False
         lossyt.tags.clear()
-        lossyt.tags.update(flactags)
+        lossyt.tags.update(tags)
+        return True
 
     elif format == 'm4a':
-        # We have to explicitly define how each tag is converted.  Sigh.
-        lossyt['\xa9nam'] = ft.get('title', [u''])
-        lossyt['\xa9ART'] = ft.get('artist', [u''])
-        lossyt['\xa9alb'] = ft.get('album', [u''])
-        lossyt['\xa9day'] = ft.get('date', [u''])
-        lossyt['trkn'] = [(int(getTracknumberStr(ft, 'flac')), 0)]  # Don't bother with totaltracks
-        lossyt['\xa9gen'] = ft.get('genre', [u''])
-        # if ft.get('album artist') == [u'Various Artists']:
-        #     lossyt['cpil'] = True
-        lossyt['aART'] = ft.get('album artist', [u''])
-        lossyt['\xa9wrt'] = ft.get('composer', [u''])
-        if 'replaygain_album_gain' in ft.keys():
-            lossyt['----:com.apple.iTunes:replaygain_album_gain'] = ft['replaygain_album_gain'][0].encode('ascii')
-            lossyt['----:com.apple.iTunes:replaygain_track_gain'] = ft['replaygain_track_gain'][0].encode('ascii')
+        changed = False
+        for k, v in tags.items():
+            if lossyt.get(k) != v:
+                lossyt[k] = v
+                changed = True
+        return changed
+
+
+def tag_padding(info):
+    """ Padding policy for tag saves.  Existing padding is kept whenever the new tags fit in
+        it, so the tags are rewritten in place without moving the audio, and a file that has
+        to grow gets room for later changes.
+    :param mutagen.PaddingInfo info: padding left over after the new tags
+    :return int: padding to write
+    """
+    if info.padding >= 0:
+        return info.padding
+    return max(info.get_default_padding(), 8192)
+
+
+class FlacTrack(object):
+    """ The parts of a flac that the sync works from: its stream info, its mtime and the tags
+        that go into the lossy files.  Embedded pictures are never read, so a whole album of
+        these stays small however much art the flacs carry.  Tags are read and set like the
+        tags of a mutagen.File.
+    """
+    __slots__ = ('filename', 'mtime', 'info', 'tags', 'tracknumber')
+
+    def __init__(self, filename, mtime, info, comments):
+        """
+        :param str filename: flac file, with path
+        :param float mtime: modification time of the flac
+        :param mutagen.flac.StreamInfo info: stream info block
+        :param mutagen.flac.VCFLACDict comments: vorbis comment block, or None
+        """
+        self.filename = filename
+        self.mtime = mtime
+        self.info = info
+        self.tags = {}
+        if comments is not None:
+            self.tags = {k: v for k, v in comments.as_dict().items() if k in trackTags}
+        try:
+            self.tracknumber = getTracknumberStr(self, 'flac')
+        except ValueError:
+            self.tracknumber = None
+
+    def get(self, key, default=None):
+        return self.tags.get(key, default)
+
+    def keys(self):
+        return self.tags.keys()
+
+    def __contains__(self, key):
+        return key in self.tags
+
+    def __getitem__(self, key):
+        return self.tags[key]
+
+    def __setitem__(self, key, value):
+        self.tags[key] = value if isinstance(value, list) else [value]
+
+    def __delitem__(self, key):
+        del self.tags[key]
+
+
+def read_flac(filename):
+    """ Reads a FlacTrack from the metadata blocks at the head of a flac, seeking past the
+        picture blocks and anything else that isn't needed.
+    :param str filename: flac file, with path
+    :return FlacTrack: the track
+    """
+    with open(filename, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        if f.read(4) != 'fLaC':
+            # Let mutagen deal with anything unusual, like an ID3 header in front
+            ft = mutagen.flac.FLAC(filename)
+            return FlacTrack(filename, mtime, ft.info, ft.tags)
+
+        info = comments = None
+        last = False
+        while not last:
+            header = f.read(4)
+            if len(header) < 4:
+                raise IOError("Truncated metadata in %s" % filename)
+            last = bool(ord(header[0]) & 0x80)
+            code = ord(header[0]) & 0x7f
+            size = struct.unpack('>I', '\x00' + header[1:])[0]
+            if code == mutagen.flac.StreamInfo.code:
+                info = mutagen.flac.StreamInfo(f.read(size))
+            elif code == mutagen.flac.VCFLACDict.code and comments is None:
+                comments = mutagen.flac.VCFLACDict(f.read(size))
+            else:
+                f.seek(size, os.SEEK_CUR)
+        if info is None:
+            raise IOError("No stream info in %s" % filename)
+    return FlacTrack(filename, mtime, info, comments)
+
+
+class LossyTrack(object):
+    """ What the sync needs to know of an existing lossy file until it has to be changed.
+    """
+    __slots__ = ('filename', 'tracknumber', 'has_art')
+
+    def __init__(self, filename, format):
+        """ Reads the lossy file, keeping only the track number and whether it has art.
+        :param str filename: lossy file, with path
+        :param str format: tag format of the file, 'ogg' or 'm4a'
+        """
+        self.filename = filename
+        lt = mutagen.File(filename)
+        try:
+            self.tracknumber = getTracknumberStr(lt, format) if lt is not None else None
+        except ValueError:
+            self.tracknumber = None
+        self.has_art = lt is not None and ('covr' in lt or 'metadata_block_picture' in lt)
+
+
+Entry = namedtuple('Entry', 'is_dir is_link size mtime')
+
+# Outcome of prepare_folder: the output folder of each target, for the targets that are up to date
+# whether the manifest confirmed it, the targets that aren't, and what was read for them
+FolderPrep = namedtuple('FolderPrep', 'outdirs current pending flactags lossytags art_hash')
+
+
+def list_dir(folder):
+    """ Lists a directory, statting each entry once.
+    :param str folder: directory to list
+    :return dict: name to Entry, or None if the directory can't be listed
+    """
+    entries = {}
+    try:
+        if scandir is not None:
+            for e in scandir(folder):
+                try:
+                    st = e.stat()
+                    entries[e.name] = Entry(stat.S_ISDIR(st.st_mode), e.is_symlink(), st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+        else:
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                    entries[name] = Entry(stat.S_ISDIR(st.st_mode), os.path.islink(path), st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return entries
+
+
+class TreeScan(object):
+    """ Cache of directory listings with the size and mtime of every entry, so each path is
+        statted once per run.  Whole trees are listed concurrently, which hides the latency
+        of network mounts.  Folders the script changes are forgotten and listed again when
+        next asked for.
+    """
+
+    def __init__(self, threads):
+        """
+        :param int threads: number of directories to list at once
+        """
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.dirs = {}
+
+    def scan(self, root):
+        """ Lists every folder under root that isn't cached yet.
+        :param str root: root of the tree to list
+        """
+        pool = ThreadPool(self.threads)
+        try:
+            with timed('walk'):
+                level = [os.path.normpath(root)]
+                while level:
+                    todo = [folder for folder in level if self.cached(folder) is None]
+                    for folder, entries in zip(todo, pool.map(list_dir, todo)):
+                        self.store(folder, entries)
+                    nextlevel = []
+                    for folder in level:
+                        entries = self.cached(folder) or {}
+                        nextlevel.extend(os.path.join(folder, name) for name, e in entries.items()
+                                         if e.is_dir and not e.is_link)
+                    level = nextlevel
+        finally:
+            pool.close()
+            pool.join()
+
+    def cached(self, folder):
+        with self.lock:
+            return self.dirs.get(folder)
+
+    def store(self, folder, entries):
+        if entries is not None:
+            with self.lock:
+                self.dirs[folder] = entries
+
+    def walk(self, root):
+        """ Walks the tree top down like os.walk, from the cached listings.
+        :param str root: root of the tree to walk
+        :return generator: (folder, subfolder names, file names) for each folder
+        """
+        self.scan(root)
+        stack = [os.path.normpath(root)]
+        while stack:
+            folder = stack.pop()
+            entries = self.cached(folder)
+            if entries is None:
+                continue
+            subfolders = sorted(name for name, e in entries.items() if e.is_dir)
+            files = sorted(name for name, e in entries.items() if not e.is_dir)
+            yield folder, subfolders, files
+            stack.extend(os.path.join(folder, name) for name in reversed(subfolders)
+                         if not entries[name].is_link)
+
+    def listing(self, folder):
+        """ Gets the listing of a folder, listing it now if it isn't cached.
+        :param str folder: directory to list
+        :return dict: name to Entry, or None if the folder doesn't exist
+        """
+        folder = os.path.normpath(folder)
+        entries = self.cached(folder)
+        if entries is None:
+            entries = list_dir(folder)
+            self.store(folder, entries)
+        return entries
+
+    def stat(self, path):
+        """ Gets the cached Entry of a path.
+        :param str path: file or directory
+        :return Entry: the entry, or None if it doesn't exist
+        """
+        folder, name = os.path.split(os.path.normpath(path))
+        entries = self.listing(folder)
+        return entries.get(name) if entries is not None else None
+
+    def isdir(self, path):
+        """ Checks for a directory, without listing it.
+        :param str path: directory to check
+        :return bool: True if the directory exists
+        """
+        path = os.path.normpath(path)
+        if self.cached(path) is not None:
+            return True
+        folder, name = os.path.split(path)
+        entries = self.cached(folder)
+        if entries is not None:
+            return name in entries and entries[name].is_dir
+        return os.path.isdir(path)
+
+    def forget(self, folder):
+        """ Drops the listing of a folder that has been changed.
+        :param str folder: directory that changed
+        """
+        with self.lock:
+            self.dirs.pop(os.path.normpath(folder), None)
+
+    def forget_tree(self, root):
+        """ Drops the listings of a folder and everything under it.
+        :param str root: directory that changed
+        """
+        root = os.path.normpath(root)
+        with self.lock:
+            for folder in [f for f in self.dirs if f == root or f.startswith(root + os.sep)]:
+                del self.dirs[folder]
+
+
+def start_scanner(threads):
+    """ Creates the tree scanner used for all listings.
+    :param int threads: number of directories to list at once
+    """
+    global _tree
+    _tree = TreeScan(threads)
+
+
+class ReadAhead(object):
+    """ Runs prepare_folder for the flac folders coming up in the walk on a few threads, so the
+        reads from slow storage overlap with the transcodes of the folders before them.  Only a
+        fixed number of folders are read ahead, which bounds the tags held waiting to be used.
+    """
+
+    def __init__(self, threads, depth):
+        """
+        :param int threads: number of folders to read at once
+        :param int depth: number of folders to read ahead of the one being synced
+        """
+        self.pool = ThreadPool(threads)
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.ready = {}
+
+    def walk(self, root, flacroot, targets, force_ascii, force_update, use_manifest, **k):
+        """ Walks a flac tree like TreeScan.walk, preparing each folder with flacs in it before it
+            is reached.
+        :param str root: root of the tree to walk
+        :param str flacroot: root of the flac conversion, for relative path determination
+        :param list[Target] targets: lossy formats and roots to write
+        :param bool force_ascii: convert characters in filenames to ascii
+        :param bool force_update: force a tag update on all lossy files
+        :param bool use_manifest: skip folders the manifest shows as unchanged
+        :return generator: (folder, subfolder names, file names) for each folder
+        """
+        ahead = deque()
+        for folder, subfolders, files in _tree.walk(root):
+            # Past the runtime budget the folders are only checked, as they come
+            if _governor is not None and _governor.out_of_time():
+                ahead.append((folder, subfolders, files))
+                yield ahead.popleft()
+            elif any(name.endswith('.flac') for name in files):
+                result = self.pool.apply_async(prepare_folder, (folder, files, flacroot, targets, force_ascii,
+                                                                force_update, use_manifest))
+                with self.lock:
+                    self.ready[folder] = (files, result)
+                ahead.append((folder, subfolders, files))
+                if len(ahead) > self.depth:
+                    yield ahead.popleft()
+            elif ahead:
+                ahead.append((folder, subfolders, files))
+            else:
+                yield folder, subfolders, files
+        while ahead:
+            yield ahead.popleft()
+
+    def take(self, folder, files):
+        """ Gets the prepared folder, waiting for it if it is still being read.
+        :param str folder: flac folder
+        :param list[str] files: list of files in the folder, no paths
+        :return FolderPrep: the prepared folder, or None if it wasn't read ahead with these files
+        """
+        with self.lock:
+            files_read, result = self.ready.pop(folder, (None, None))
+        if result is None or files_read != files:
+            return None
+        return result.get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def start_reader(threads):
+    """ Creates the read-ahead used by the walk of the flac trees.
+    :param int threads: number of folders to read at once
+    """
+    global _reader
+    if threads > 1:
+        _reader = ReadAhead(threads, threads * 4)
+
+
+def close_reader():
+    """ Shuts the read-ahead down, so later syncs read their folders as they come to them.
+    """
+    global _reader
+    if _reader is not None:
+        _reader.close()
+        _reader = None
 
 
 def does_dir_need_update(check_dir, dest_format, input_files):
@@ -103,11 +611,12 @@ def does_dir_need_update(check_dir, dest_format, input_files):
         return False
 
     # If it doesn't exist, we need to transcode.
-    if not os.path.isdir(check_dir):
+    check_entries = _tree.listing(check_dir)
+    if check_entries is None:
         return True
 
     # Get the listing of the check dir.
-    check_dir_files = [os.path.join(check_dir, check_file) for check_file in os.listdir(check_dir)]
+    check_dir_files = [os.path.join(check_dir, check_file) for check_file in check_entries]
 
     # How many of our target type?
     num_format = len([check_file for check_file in check_dir_files if check_file.endswith(dest_format)])
@@ -117,17 +626,17 @@ def does_dir_need_update(check_dir, dest_format, input_files):
 
     # Is there a folder.jpg file in the source tree?
     if not any([f.endswith(os.sep + 'folder.jpg') for f in input_files]):
-        print >> sys.stderr, "No album art for {} - Fix this ASAP!".format(os.path.dirname(input_files[0]))
+        print_lines(sys.stderr, "No album art for {} - Fix this ASAP!".format(os.path.dirname(input_files[0])))
     elif not any([f.endswith(os.sep + 'folder.jpg') for f in check_dir_files]):
         # If there's a folder.jpg in the source, but not in the check_dir, process the folder.
         return True
 
     # What is the latest timestamp of the flac/folder.jpg files in the input_files?
-    latest_source_time = max([os.path.getmtime(f) for f in input_files
+    latest_source_time = max([_tree.stat(f).mtime for f in input_files
                               if f.endswith('.flac') or f.endswith(os.sep + 'folder.jpg')])
 
     # What is the latest timestamp of the target type?
-    latest_target_time = max([os.path.getmtime(f) for f in check_dir_files
+    latest_target_time = max([check_entries[os.path.basename(f)].mtime for f in check_dir_files
                               if f.endswith(dest_format) or f.endswith(os.sep + 'folder.jpg')])
 
     if latest_source_time > latest_target_time:
@@ -138,7 +647,7 @@ def does_dir_need_update(check_dir, dest_format, input_files):
 
 def set_album_artist_tags(flacs):
     """ Sets the album artist tag properly for the collection.
-    :param list[mutagen.File] flacs: list of flacs with information
+    :param list[FlacTrack] flacs: list of flacs with information
     """
     unique_artists = set([f['artist'][-1] for f in flacs])
     if len(unique_artists) > 1:
@@ -158,285 +667,2081 @@ def set_album_artist_tags(flacs):
             ft['album artist'] = new_aa
 
 
+def needs_rg(flacs):
+    """ Checks each track for the album gain tag.
+    :param list[FlacTrack] flacs: flac tracks
+    :return bool: True if any track is missing replaygain
+    """
+    return not all('replaygain_album_gain' in f for f in flacs)
+
+
+def can_fuse_rg(flacs):
+    """ Checks that the in-process analyzer can handle the album.
+    :param list[FlacTrack] flacs: flac tracks
+    :return bool: True if the replaygain can be computed while transcoding
+    """
+    if numpy is None:
+        return False
+    return all(f.info.sample_rate in rg_filters and f.info.channels in (1, 2) and
+               f.info.bits_per_sample in (16, 24) for f in flacs)
+
+
+class ReplayGainAnalyzer(object):
+    """ Computes the ReplayGain loudness histogram and peak of a decoded track as its PCM
+        streams past, following the metaflac (gain_analysis.c) algorithm.
+    """
+
+    def __init__(self, rate, channels, bits):
+        """
+        :param int rate: sample rate
+        :param int channels: 1 or 2
+        :param int bits: 16 or 24
+        """
+        self.channels = channels
+        self.width = bits // 8
+        self.scale = 2.0 ** (bits - 16)  # gain_analysis works on 16 bit sample values
+        self.fullscale = 2.0 ** (bits - 1)
+        self.window = int(math.ceil(rate * 0.05))
+        (self.yb, self.ya), (self.bb, self.ba) = rg_filters[rate]
+        self.yz = [numpy.zeros(len(self.ya) - 1) for _ in range(channels)]
+        self.bz = [numpy.zeros(len(self.ba) - 1) for _ in range(channels)]
+        self.pending = ''
+        self.energy = numpy.zeros(0)
+        self.histogram = numpy.zeros(rg_steps_per_db * rg_max_db, dtype=numpy.int64)
+        self.peak = 0.0
+
+    def feed(self, data):
+        """ Analyzes a chunk of interleaved little-endian PCM.
+        :param str data: raw sample bytes, which may end part way through a frame
+        """
+        data = self.pending + data
+        framesize = self.width * self.channels
+        usable = len(data) - len(data) % framesize
+        self.pending = data[usable:]
+        if usable == 0:
+            return
+
+        if self.width == 2:
+            samples = numpy.frombuffer(data[:usable], dtype='<i2').astype(numpy.float64)
+        else:
+            raw = numpy.frombuffer(data[:usable], dtype=numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+            ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+            samples = numpy.where(ints >= 1 << 23, ints - (1 << 24), ints).astype(numpy.float64)
+        samples = samples.reshape(-1, self.channels)
+
+        self.peak = max(self.peak, numpy.abs(samples).max() / self.fullscale)
+
+        energy = numpy.zeros(len(samples))
+        for c in range(self.channels):
+            x = samples[:, c] / self.scale
+            y, self.yz[c] = lfilter(self.yb, self.ya, x, zi=self.yz[c])
+            y, self.bz[c] = lfilter(self.bb, self.ba, y, zi=self.bz[c])
+            energy += y * y
+        if self.channels == 1:
+            # gain_analysis treats mono as the same signal in both channels
+            energy *= 2
+
+        # Histogram the loudness of each complete 50ms window, keeping the leftovers
+        energy = numpy.concatenate((self.energy, energy))
+        nwin = len(energy) // self.window
+        self.energy = energy[nwin * self.window:]
+        if nwin == 0:
+            return
+        means = energy[:nwin * self.window].reshape(nwin, self.window).sum(axis=1) / self.window * 0.5
+        steps = (rg_steps_per_db * 10 * numpy.log10(means + 1e-37)).astype(numpy.int64)
+        steps = numpy.clip(steps, 0, len(self.histogram) - 1)
+        self.histogram += numpy.bincount(steps, minlength=len(self.histogram))
+
+
+def rg_gain(histogram):
+    """ Converts a loudness histogram to a replaygain value.
+    :param numpy.ndarray histogram: window counts from ReplayGainAnalyzer
+    :return float: gain in dB, or None if there were no complete windows
+    """
+    elems = histogram.sum()
+    if elems == 0:
+        return None
+    upper = int(math.ceil(elems * (1 - 0.95)))
+    i = len(histogram) - 1
+    while i > 0:
+        upper -= histogram[i]
+        if upper <= 0:
+            break
+        i -= 1
+    return rg_pink_ref - float(i) / rg_steps_per_db
+
+
+def read_wav_header(stream):
+    """ Reads the RIFF header of a decoded stream up to the start of the sample data.
+    :param file stream: stream positioned at the start of a WAV file
+    :return tuple: (header bytes, sample rate, channels, bits per sample)
+    """
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != 'RIFF' or header[8:12] != 'WAVE':
+        raise IOError("Decoder did not produce a WAV stream")
+    fmt = None
+    while True:
+        chunkhead = stream.read(8)
+        if len(chunkhead) < 8:
+            raise IOError("No sample data in the decoded stream")
+        header += chunkhead
+        chunkid, size = struct.unpack('<4sI', chunkhead)
+        if chunkid == 'data':
+            break
+        body = stream.read(size + size % 2)
+        header += body
+        if chunkid == 'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[:16])
+    if fmt is None:
+        raise IOError("No format chunk in the decoded stream")
+    return header, fmt[2], fmt[1], fmt[5]
+
+
+def grow_pipe(pipe):
+    """ Raises the kernel buffer of a pipe, so the decoder and encoders stall on each other
+        less often.  Only Linux allows this, elsewhere the default size is kept.
+    :param file pipe: end of the pipe
+    """
+    try:
+        fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, pipe_size)
+    except (IOError, OSError):
+        pass
+
+
+def read_errors(errfile):
+    """ Reads what a process wrote to its stderr file.
+    :param file errfile: temporary file the stderr went to
+    :return str: the output, stripped
+    """
+    errfile.seek(0)
+    return errfile.read().strip()
+
+
+def decode_to_encoders(flacfile, enc_argvs, analyze, abort=None):
+    """ Decodes a flac file once, feeding the PCM to each of the encoders and, if asked,
+        to the replaygain analyzer at the same time.  The processes are run directly, without
+        a shell, and the stderr of each one is kept for the failure messages.  With -b, the
+        governor has to let the transcode start first.
+    :param str flacfile: flac file to decode
+    :param list[list[str]] enc_argvs: encoder command lines reading WAV from stdin, may be empty
+    :param bool analyze: run the replaygain analyzer over the decoded audio
+    :param threading.Event abort: set to stop the transcode and kill the processes, or None
+    :return tuple: (ReplayGainAnalyzer or None, list[bool] success of each encoder,
+                    list[str] error output of each encoder)
+    """
+    with governed():
+        return run_decode_to_encoders(flacfile, enc_argvs, analyze, abort)
+
+
+def run_decode_to_encoders(flacfile, enc_argvs, analyze, abort):
+    """ Does the work of decode_to_encoders, once the governor lets it start.
+    """
+    folder = os.path.dirname(flacfile)
+    errfiles = [tempfile.TemporaryFile() for _ in range(len(enc_argvs) + 1)]
+    devnull = open(os.devnull, 'w')
+    dec = None
+    encs = []
+    # Time spent waiting on the decoder, on the encoders and in the analyzer
+    read_wall = write_wall = rg_wall = 0.0
+    try:
+        dec = Popen(['flac', '--silent', '-d', '-c', flacfile], stdout=PIPE, stderr=errfiles[0], bufsize=-1)
+        grow_pipe(dec.stdout)
+        encs = [Popen(argv, stdin=PIPE, stdout=devnull, stderr=errfile, bufsize=-1)
+                for argv, errfile in zip(enc_argvs, errfiles[1:])]
+        for enc in encs:
+            grow_pipe(enc.stdin)
+        feeding = [True] * len(encs)
+
+        def write_all(data):
+            for i, enc in enumerate(encs):
+                if feeding[i]:
+                    try:
+                        enc.stdin.write(data)
+                    except IOError:
+                        # This encoder gave up, keep going for the others
+                        feeding[i] = False
+
+        header, rate, channels, bits = read_wav_header(dec.stdout)
+        analyzer = ReplayGainAnalyzer(rate, channels, bits) if analyze else None
+        write_all(header)
+        while True:
+            t0 = time.time()
+            chunk = dec.stdout.read(1 << 18)
+            t1 = time.time()
+            read_wall += t1 - t0
+            if not chunk:
+                break
+            if abort is not None and abort.is_set():
+                raise RuntimeError("transcode aborted")
+            write_all(chunk)
+            t2 = time.time()
+            write_wall += t2 - t1
+            if analyzer:
+                analyzer.feed(chunk)
+                rg_wall += time.time() - t2
+        for enc in encs:
+            try:
+                enc.stdin.close()
+            except IOError:
+                pass
+        # The CPU time of the decoder and encoders is counted as each one is waited for
+        with timed('encode', folder):
+            ok = [enc.wait() == 0 and feeding[i] for i, enc in enumerate(encs)]
+        with timed('decode', folder):
+            decoded = dec.wait() == 0
+        if _stats is not None:
+            _stats.add('decode', folder, read_wall, bytes_read=os.path.getsize(flacfile), calls=0)
+            _stats.add('encode', folder, write_wall, calls=0)
+            if analyzer:
+                _stats.add('replaygain', folder, rg_wall)
+        errors = [read_errors(errfile) for errfile in errfiles[1:]]
+        if not decoded:
+            return None, [False] * len(encs), [read_errors(errfiles[0])] * len(encs)
+        return analyzer, ok, errors
+    except Exception as e:
+        for p in [dec] + encs:
+            if p is not None and p.poll() is None:
+                p.kill()
+                p.wait()
+        # Drop what is left buffered for the killed encoders
+        for enc in encs:
+            try:
+                enc.stdin.close()
+            except IOError:
+                pass
+        return None, [False] * len(enc_argvs), [str(e)] * len(enc_argvs)
+    finally:
+        devnull.close()
+        for errfile in errfiles:
+            errfile.close()
+
+
+def print_lines(stream, *lines):
+    """ Prints lines together, under the print lock, as the worker and tag pools print from their
+        threads while the walk prints from the main one.
+    :param file stream: sys.stdout or sys.stderr
+    :param *lines: lines to print
+    """
+    with _print_lock:
+        for line in lines:
+            print >> stream, line
+
+
+def print_failure(flacfile, newname, error):
+    """ Prints a failed transcode, with the end of the error output that went with it.
+    :param str flacfile: flac file that was being transcoded
+    :param str newname: output filename, with path
+    :param str error: error output of the encoder or decoder
+    """
+    print_lines(sys.stderr, "Failure converting %s to %s" % (flacfile, newname),
+                *(["     %s" % line for line in error.splitlines()[-5:]] +
+                  ["  -  skipping file and continuing to process..."]))
+
+
+def fused_rg_album(flacs, new_outputs, thefolder):
+    """ Computes and writes the replaygain tags of an album while transcoding it, so that
+        each flac is decoded only once, whatever the number of targets.
+    :param list[FlacTrack] flacs: the tracks of the album, which get the new replaygain tags too
+    :param dict new_outputs: flac filename to list of (Target, lossy filename) still to transcode
+    :param str thefolder: flac folder, for messages
+    :return dict: flac filename to list of (Target, lossy filename) that were written
+    """
+    args = [(ft.filename, [target.encoder_argv(partial_name(newname))
+                           for target, newname in new_outputs.get(ft.filename, [])], True) for ft in flacs]
+    jobs = None
+    if _pool is not None:
+        jobs = [_pool.apply_async(decode_to_encoders, a) for a in args]
+
+    # Take each result as it comes, keeping only the track's gain and peak and the album histogram
+    encoded = {}
+    gains = []
+    album_histogram = None
+    for i, ft in enumerate(flacs):
+        if jobs is None:
+            analyzer, ok, errors = decode_to_encoders(*args[i])
+        else:
+            analyzer, ok, errors = jobs[i].get()
+            jobs[i] = None
+        outputs = new_outputs.get(ft.filename, [])
+        encoded[ft.filename] = [output for output, done in zip(outputs, ok) if done]
+        for (target, newname), done, error in zip(outputs, ok, errors):
+            if not done:
+                print_failure(ft.filename, newname, error)
+                abandon_output(ft, target, newname)
+        if analyzer is None:
+            print_lines(sys.stderr, "Failure decoding %s" % ft.filename)
+            gains = None
+        elif gains is not None:
+            gains.append((rg_gain(analyzer.histogram), analyzer.peak))
+            if album_histogram is None:
+                album_histogram = analyzer.histogram
+            else:
+                album_histogram += analyzer.histogram
+    if gains is None:
+        print_lines(sys.stderr, "Failure replaygaining flacs in folder %s" % thefolder,
+                    "  -  continuing without replaygain tags...")
+        return encoded
+
+    album_gain = rg_gain(album_histogram)
+    album_peak = max(peak for gain, peak in gains)
+    if album_gain is None:
+        print_lines(sys.stderr, "Not enough audio to replaygain folder %s" % thefolder)
+        return encoded
+
+    for ft, (track_gain, track_peak) in zip(flacs, gains):
+        rgtags = {'replaygain_reference_loudness': u'89.0 dB',
+                  'replaygain_track_gain': u'%+.2f dB' % (track_gain if track_gain is not None else album_gain),
+                  'replaygain_track_peak': u'%.8f' % track_peak,
+                  'replaygain_album_gain': u'%+.2f dB' % album_gain,
+                  'replaygain_album_peak': u'%.8f' % album_peak}
+        try:
+            with timed('save', thefolder):
+                flac = mutagen.flac.FLAC(ft.filename)
+                for k, v in rgtags.items():
+                    flac[k] = v
+                flac.save()
+            for k, v in rgtags.items():
+                ft[k] = v
+            ft.mtime = os.path.getmtime(ft.filename)
+        except Exception:
+            print_lines(sys.stderr, "Failure writing replaygain tags to %s" % ft.filename)
+
+    return encoded
+
+
 def apply_rg_to_flacs(flacs, folder_of_flacs):
     """ Checks to see if replaygain has been applied to all tracks, and if not,
         run the replaygain call.
-    :param list[mutagen.File] flacs: flac mutagen objects
+    :param list[FlacTrack] flacs: flac tracks
     :param str folder_of_flacs: folder for replaygaining
     """
-    # Check each track for the album gain tag
-    # If any are missing, rerun metaflac --add-replay-gain *.flac on directory
-    do_rg = not all('replaygain_album_gain' in f for f in flacs)
-
-    if do_rg:
-        rgcmd = 'metaflac --add-replay-gain *.flac'
+    # If any are missing the album gain tag, rerun metaflac --add-replay-gain on the whole album
+    if needs_rg(flacs):
+        rgcmd = ['metaflac', '--add-replay-gain'] + sorted(os.path.basename(f.filename) for f in flacs)
 
         try:
-            retcode = call(rgcmd, shell=True, cwd=folder_of_flacs)
-            if retcode < 0:
-                print >> sys.stderr, "Failure replaygaining flacs in folder %s", folder_of_flacs
-                print >> sys.stderr, "  -  skipping folder and continuing to process..."
+            with governed(), timed('replaygain', folder_of_flacs):
+                retcode = call(rgcmd, cwd=folder_of_flacs)
+            if retcode != 0:
+                print_lines(sys.stderr, "Failure replaygaining flacs in folder %s" % folder_of_flacs,
+                            "  -  skipping folder and continuing to process...")
                 return
         except Exception:
-            print >> sys.stderr, "Failure replaygaining flacs in folder %s", folder_of_flacs
-            print >> sys.stderr, "  -  skipping folder and continuing to process..."
+            print_lines(sys.stderr, "Failure replaygaining flacs in folder %s" % folder_of_flacs,
+                        "  -  skipping folder and continuing to process...")
+            return
+
+
+def audio_id(ft):
+    """ Gets a stable identity for the audio of a flac, from the MD5 of the decoded audio in its
+        STREAMINFO block, which survives renames, moves and retagging.
+    :param FlacTrack ft: flac file to identify
+    :return str: the identity, or None if the flac has no audio MD5
+    """
+    if not ft.info.md5_signature:
+        return None
+    return '%032x-%d' % (ft.info.md5_signature, ft.info.total_samples)
+
+
+def track_cost(ft):
+    """ Estimates the work of transcoding a flac from its STREAMINFO, as the length of the audio
+        scaled by its sample rate to seconds of 44.1 kHz audio.
+    :param FlacTrack ft: flac file to estimate
+    :return float: the cost
+    """
+    return ft.info.length * ft.info.sample_rate / 44100.0
+
+
+def tag_hash(ft):
+    """ Hashes the tags that get copied to the lossy files.
+    :param FlacTrack ft: flac file to hash the tags of
+    :return str: hex digest of the kept tags
+    """
+    items = sorted((k, v) for k, v in ft.tags.items() if k in keepTags)
+    return hashlib.sha1(repr(items)).hexdigest()
+
+
+class SyncManifest(object):
+    """ SQLite index of what has been synced into a lossy root.  Each track row records the
+        source stat, the hashes of the tags and art that went into the output file, its mtime
+        and the encoder settings used, so an unchanged folder can be confirmed from a stat pass alone.
+        It also journals the transcodes in flight, so an interrupted run can be resumed.
+    """
+
+    def __init__(self, dbfile, simulate=False):
+        """
+        :param str dbfile: path of the manifest database
+        :param bool simulate: only read the manifest.  One with an old layout is closed unchanged,
+                              leaving db None.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.text_factory = str
+        current = self.db.execute('PRAGMA user_version').fetchone()[0] == manifest_version
+        if simulate:
+            if not current:
+                self.db.close()
+                self.db = None
             return
+        # The manifest is only a cache of the lossy tree, so an old layout is simply rebuilt
+        if not current:
+            self.db.execute('DROP TABLE IF EXISTS tracks')
+            self.db.execute('DROP TABLE IF EXISTS art')
+            self.db.execute('DROP TABLE IF EXISTS jobs')
+            self.db.execute('PRAGMA user_version = %d' % manifest_version)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS tracks (
+                               source TEXT, folder TEXT, size INTEGER, mtime REAL, tag_hash TEXT,
+                               art_hash TEXT, output TEXT, enc_ext TEXT, encopts TEXT, audio_id TEXT,
+                               output_mtime REAL, PRIMARY KEY (source, enc_ext))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tracks_folder ON tracks (folder, enc_ext)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tracks_audio ON tracks (audio_id)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS art (
+                               source TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                               source TEXT, folder TEXT, output TEXT, enc_ext TEXT,
+                               PRIMARY KEY (source, enc_ext))''')
+
+    def folder_is_current(self, thefolder, flac_files, flacart, enc_ext, encopts):
+        """ Checks the folder against the manifest using only stat calls.  The lossy files have to
+            still be there as they were written as well, so deleting one has it transcoded again.
+        :param str thefolder: flac folder to check
+        :param list[str] flac_files: flac files in the folder, with paths
+        :param str flacart: source folder.jpg, or None
+        :param str enc_ext: format of the lossy files
+        :param str encopts: encoder options for the lossy files
+        :return bool: True if every track was synced from the files as they are now
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT source, size, mtime, art_hash, encopts, output, output_mtime '
+                                   'FROM tracks WHERE folder = ? AND enc_ext = ?', (thefolder, enc_ext)).fetchall()
+            art = None
+            if flacart:
+                art = self.db.execute('SELECT size, mtime, hash FROM art WHERE source = ?',
+                                      (flacart,)).fetchone()
+            unfinished = self.db.execute('SELECT COUNT(*) FROM jobs WHERE folder = ? AND enc_ext = ?',
+                                         (thefolder, enc_ext)).fetchone()[0]
+
+        if len(rows) != len(flac_files) or unfinished:
+            return False
+
+        art_hash = None
+        if flacart:
+            if art is None:
+                return False
+            st = _tree.stat(flacart)
+            if st is None or (st.size, st.mtime) != art[:2]:
+                return False
+            art_hash = art[2]
+
+        known = dict((row[0], row[1:]) for row in rows)
+        for flac_file in flac_files:
+            row = known.get(flac_file)
+            if row is None:
+                return False
+            st = _tree.stat(flac_file)
+            if st is None or (st.size, st.mtime, art_hash, encopts) != row[:4]:
+                return False
+            # Lossy files the manifest doesn't know are left to the check of the output folder
+            if row[4] is None:
+                return False
+            st = _tree.stat(row[4])
+            if st is None or st.mtime != row[5]:
+                return False
+
+        return True
+
+    def folder_outputs(self, thefolder, enc_ext, flac_files):
+        """ Gets the lossy files made from the flacs of a folder.
+        :param str thefolder: flac folder
+        :param str enc_ext: format of the lossy files
+        :param list[str] flac_files: flac files in the folder, with paths
+        :return dict: flac file to (lossy file with path, audio_id), either of which may be None
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT source, output, audio_id FROM tracks WHERE folder = ? AND enc_ext = ?',
+                                   (thefolder, enc_ext)).fetchall()
+        known = dict((row[0], row[1:]) for row in rows)
+        return dict((flac_file, known.get(flac_file, (None, None))) for flac_file in flac_files)
+
+    def find_audio(self, audio_id, enc_ext, encopts):
+        """ Finds the lossy files made from the same audio as a flac, wherever it was.
+        :param str audio_id: source identity from audio_id
+        :param str enc_ext: format of the lossy files
+        :param str encopts: encoder options the lossy files must have been made with
+        :return list[tuple]: (flac file, lossy file) for each match, with paths
+        """
+        with self.lock:
+            return self.db.execute('SELECT source, output FROM tracks WHERE audio_id = ? AND enc_ext = ? '
+                                   'AND encopts = ? AND output IS NOT NULL',
+                                   (audio_id, enc_ext, encopts)).fetchall()
+
+    def forget_track(self, source, enc_ext):
+        """ Drops a track whose lossy file has been moved to another flac.
+        :param str source: flac file, with path
+        :param str enc_ext: format of the lossy files
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM tracks WHERE source = ? AND enc_ext = ?', (source, enc_ext))
+
+    def forget_folder(self, thefolder, enc_ext):
+        """ Drops the tracks of a folder that is about to be reprocessed.
+        :param str thefolder: flac folder
+        :param str enc_ext: format of the lossy files
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM tracks WHERE folder = ? AND enc_ext = ?', (thefolder, enc_ext))
+
+    def record_art(self, flacart, art_hash):
+        """ Records the source art of a folder.
+        :param str flacart: source folder.jpg
+        :param str art_hash: hex digest of the art, from file_hash
+        """
+        st = _tree.stat(flacart)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO art VALUES (?, ?, ?, ?)',
+                            (flacart, st.size, st.mtime, art_hash))
+
+    def record_track(self, source, thefolder, tags, art_hash, output, enc_ext, encopts, audio=None):
+        """ Records a track that is in sync with its lossy output.
+        :param str source: flac file, with path
+        :param str thefolder: flac folder
+        :param str tags: hash of the kept tags from tag_hash, or None if not loaded
+        :param str art_hash: hash of the art in the output, or None
+        :param str output: lossy file, with path, or None if not known
+        :param str enc_ext: format of the lossy file
+        :param str encopts: encoder options used for the lossy file
+        :param str audio: source identity from audio_id, or None if not known
+        """
+        st = _tree.stat(source)
+        # Straight from the file, the listing may be from before it was written
+        output_mtime = os.path.getmtime(output) if output is not None else None
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (source, thefolder, st.size, st.mtime, tags, art_hash, output,
+                             enc_ext, encopts, audio, output_mtime))
+
+    def journal_job(self, source, thefolder, output, enc_ext):
+        """ Journals a transcode before it starts.  The journal is written out straight away,
+            so it survives the run being killed.
+        :param str source: flac file, with path
+        :param str thefolder: flac folder
+        :param str output: lossy file, with path
+        :param str enc_ext: format of the lossy file
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)',
+                            (source, thefolder, output, enc_ext))
+            self.db.commit()
+
+    def finish_job(self, source, enc_ext):
+        """ Takes a transcode that is done with, successfully or not, off the journal.
+        :param str source: flac file, with path
+        :param str enc_ext: format of the lossy file
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE source = ? AND enc_ext = ?', (source, enc_ext))
+
+    def unfinished_jobs(self, enc_ext):
+        """ Gets the transcodes that were still on the journal when a run stopped.
+        :param str enc_ext: format of the lossy files
+        :return list[tuple]: (flac folder, lossy file) for each transcode
+        """
+        with self.lock:
+            return self.db.execute('SELECT folder, output FROM jobs WHERE enc_ext = ?', (enc_ext,)).fetchall()
+
+    def forget_jobs(self, thefolder, enc_ext):
+        """ Drops the journaled transcodes of a folder that is gone.
+        :param str thefolder: flac folder
+        :param str enc_ext: format of the lossy files
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE folder = ? AND enc_ext = ?', (thefolder, enc_ext))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+def file_hash(filename):
+    """ Hashes the contents of a file.
+    :param str filename: file to hash
+    :return str: hex digest of the file
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def open_manifests(targets, simulate):
+    """ Opens the sync manifest kept in the lossy root of each target.  Targets sharing a
+        root share the manifest.
+    :param list[Target] targets: output targets
+    :param bool simulate: only read existing manifests, never create one
+    """
+    manifests = {}
+    for target in targets:
+        dbfile = os.path.join(target.lossyroot, manifest_name)
+        if simulate and not os.path.exists(dbfile):
+            continue
+        if dbfile not in manifests:
+            if not os.path.isdir(target.lossyroot):
+                os.makedirs(target.lossyroot)
+            manifests[dbfile] = SyncManifest(dbfile, simulate)
+        # A simulated run treats a manifest of an old layout as missing, rather than rebuild it
+        if manifests[dbfile].db is not None:
+            target.manifest = manifests[dbfile]
+
+
+def close_manifests(targets):
+    """ Writes out and closes the sync manifests.
+    :param list[Target] targets: output targets
+    """
+    for target in targets:
+        if target.manifest is not None and target.manifest.db is not None:
+            target.manifest.close()
+        target.manifest = None
+
+
+def start_pool(jobs):
+    """ Creates the worker pool used for transcode jobs.  With a single job, transcodes
+        run inline in the walk, exactly as before.
+    :param int jobs: number of transcodes to run at once
+    """
+    global _pool, _pool_slots
+    if jobs > 1:
+        _pool = ThreadPool(jobs)
+        # Bound the number of queued jobs so the walk doesn't hold every flac in memory.  The
+        # queue is run longest job first, so it is deep enough to even out the workers.
+        _pool_slots = threading.BoundedSemaphore(jobs * 16)
+
+
+def start_tag_pool(threads):
+    """ Creates the thread pool used for tag and art updates.  These wait on the disk much more
+        than on the CPU, so the pool is sized like the tree scanner rather than by -j.
+    :param int threads: number of output folders to update at once
+    """
+    global _tag_pool, _tag_limit
+    if threads > 1:
+        _tag_pool = ThreadPool(threads)
+        # Bound the number of queued folders so the walk doesn't get far ahead
+        _tag_limit = threads * 4
+
+
+def submit_tag_job(f, *a):
+    """ Runs f(*a) on the tag pool if there is one, otherwise runs it right away.
+    :param function f: job function to run
+    :param *a: arguments for the job function
+    """
+    global _tag_pending
+    if _tag_pool is None:
+        f(*a)
+        return
+
+    def run_job():
+        global _tag_pending
+        try:
+            f(*a)
+        except Exception as e:
+            print_lines(sys.stderr, "Unexpected failure in tag job: %s" % e)
+        finally:
+            with _tag_cond:
+                _tag_pending -= 1
+                _tag_cond.notify_all()
+
+    with _tag_cond:
+        while _tag_pending >= _tag_limit:
+            _tag_cond.wait()
+        _tag_pending += 1
+    _tag_pool.apply_async(run_job)
+
+
+def wait_for_tags():
+    """ Waits for all of the queued tag and art updates to finish.
+    """
+    with _tag_cond:
+        while _tag_pending:
+            _tag_cond.wait()
+
+
+def wait_for_pool():
+    """ Waits for all of the queued transcode jobs to finish, including those handed out to
+        workers by the job server, and for the tag and art updates.
+    """
+    global _pool
+    wait_for_tags()
+    if _jobserver is not None:
+        _jobserver.wait()
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def submit_job(cost, f, *a):
+    """ Runs f(*a) on the worker pool if there is one, otherwise runs it right away.  Each
+        worker that comes free takes the costliest job waiting, not the oldest.
+    :param float cost: estimated cost of the job, see track_cost
+    :param function f: job function to run
+    :param *a: arguments for the job function
+    """
+    if _pool is None:
+        f(*a)
+        return
+
+    def run_job():
+        with _pool_lock:
+            job, args = heapq.heappop(_pool_queue)[2:]
+        try:
+            job(*args)
+        except Exception as e:
+            print_lines(sys.stderr, "Unexpected failure in transcode job: %s" % e)
+        finally:
+            _pool_slots.release()
+
+    _pool_slots.acquire()
+    with _pool_lock:
+        heapq.heappush(_pool_queue, (-cost, next(_pool_seq), f, a))
+    _pool.apply_async(run_job)
+
+
+def print_progress(thefolder, tracknum):
+    """ Prints the progress marker for a track.  When running in parallel, each finished
+        track gets a full line so output from different albums stays readable.
+    :param str thefolder: folder the track is in
+    :param str tracknum: track number string
+    """
+    with _print_lock:
+        if _pool is None and _jobserver is None:
+            print tracknum, "...",
+            sys.stdout.flush()
+        else:
+            print "%s: %s done" % (thefolder, tracknum)
+
+
+def cpu_time():
+    """ Gets the CPU time used so far by the script and by its child processes that have been
+        waited for.
+    :return float: user plus system time in seconds
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+class RunStats(object):
+    """ Wall and CPU time, bytes read and written and seconds of audio transcoded for each
+        stage of the run, in total and per album.  CPU times are process wide and include the
+        decoders and encoders once they've exited, so with -j they overlap between stages
+        running at the same time.
+    """
+
+    def __init__(self, report, progress):
+        """
+        :param str report: file to write the report to, csv if it ends in .csv, otherwise json
+        :param bool progress: print a throughput and ETA line as the walk goes
+        """
+        self.report = report
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.cpu_start = cpu_time()
+        self.stages = {}
+        self.albums = {}
+        self.total_flacs = 0
+        self.seen_flacs = 0
+        self.last_progress = self.start
+
+    def add(self, stage, folder, wall=0.0, cpu=0.0, bytes_read=0, bytes_written=0, audio_seconds=0.0,
+            calls=1):
+        """ Adds to the totals of a stage.
+        :param str stage: stage name
+        :param str folder: flac folder the work was for, or None if it wasn't for one album
+        """
+        values = (calls, wall, cpu, bytes_read, bytes_written, audio_seconds)
+        with self.lock:
+            rows = [self.stages.setdefault(stage, [0] * len(stat_fields))]
+            if folder is not None:
+                rows.append(self.albums.setdefault(folder, {}).setdefault(stage, [0] * len(stat_fields)))
+            for row in rows:
+                for i, v in enumerate(values):
+                    row[i] += v
+
+    def expect(self, flacroot):
+        """ Counts the flacs under a root, for the ETA.
+        :param str flacroot: root of the flac tree, already scanned
+        """
+        self.total_flacs += sum(1 for folder, subfolders, files in _tree.walk(flacroot)
+                                for f in files if f.endswith('.flac'))
+
+    def visit(self, nflacs):
+        """ Notes that the flacs of another folder have been reached, printing the progress
+            line at most once a second.
+        :param int nflacs: number of flacs in the folder
+        """
+        self.seen_flacs += nflacs
+        now = time.time()
+        if not self.progress or now - self.last_progress < 1:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.start
+        with self.lock:
+            zero = [0] * len(stat_fields)
+            audio = self.stages.get('encode', zero)[5]
+            read = self.stages.get('decode', zero)[3]
+        eta = '?'
+        if self.seen_flacs:
+            remaining = int(elapsed * (self.total_flacs - self.seen_flacs) / self.seen_flacs)
+            eta = '%d:%02d:%02d' % (remaining // 3600, remaining // 60 % 60, remaining % 60)
+        print_lines(sys.stderr, "%d/%d flacs, %.1fx realtime, %.1f MB/s, ETA %s" % (
+            self.seen_flacs, self.total_flacs, audio / elapsed, read / elapsed / 1e6, eta))
+
+    def summary(self, row):
+        """ Converts a row of totals to a dict, adding the realtime factor.
+        :param dict row: stage name to list of totals
+        :return dict: the totals over all of the stages, with the stages themselves
+        """
+        stages = dict((stage, dict(zip(stat_fields, values))) for stage, values in row.items())
+        total = dict((field, sum(values[i] for values in row.values())) for i, field in enumerate(stat_fields))
+        transcode = sum(row[stage][1] for stage in ('decode', 'encode') if stage in row)
+        total['realtime'] = total['audio_seconds'] / transcode if transcode else None
+        total['stages'] = stages
+        return total
+
+    def write_report(self):
+        """ Writes the run report, with the run as a whole and each album broken down by stage.
+        """
+        run = self.summary(self.stages)
+        run['wall'] = time.time() - self.start
+        run['cpu'] = cpu_time() - self.cpu_start
+        run['flacs'] = self.seen_flacs
+        albums = dict((folder, self.summary(row)) for folder, row in self.albums.items())
+
+        if self.report.endswith('.csv'):
+            with open(self.report, 'wb') as f:
+                w = csv.writer(f)
+                w.writerow(('album', 'stage') + stat_fields + ('realtime',))
+                for folder, summary in [('', run)] + sorted(albums.items()):
+                    for stage, values in sorted(summary['stages'].items()):
+                        w.writerow([folder, stage] + [values[field] for field in stat_fields] + [''])
+                    w.writerow([folder, 'total'] + [summary[field] for field in stat_fields] +
+                               [summary['realtime']])
+        else:
+            with open(self.report, 'w') as f:
+                json.dump({'run': run, 'albums': albums}, f, indent=2, sort_keys=True)
+
+
+def start_stats(report, progress):
+    """ Starts collecting the stage timings, if there's a report to write or progress to show.
+    :param str report: file to write the report to, or None
+    :param bool progress: print a throughput and ETA line as the walk goes
+    """
+    global _stats
+    if report or progress:
+        _stats = RunStats(report, progress)
+
+
+def close_stats():
+    """ Writes the run report, if one was asked for.
+    """
+    global _stats
+    if _stats is not None and _stats.report:
+        _stats.write_report()
+    _stats = None
+
+
+@contextmanager
+def timed(stage, folder=None):
+    """ Times the body of a with statement as a stage of the run.
+    :param str stage: stage name
+    :param str folder: flac folder the work is for, or None
+    """
+    if _stats is None:
+        yield
+        return
+    wall, cpu = time.time(), cpu_time()
+    try:
+        yield
+    finally:
+        _stats.add(stage, folder, time.time() - wall, cpu_time() - cpu)
+
+
+PlanJob = namedtuple('PlanJob', 'kind folder source output cost')
+
+
+class RunPlan(object):
+    """ The jobs a run finds to do: adding replaygain, transcoding, moving lossy files of
+        renamed flacs, retagging, re-arting and purging.  Each carries a cost estimate from
+        track_cost, in seconds of 44.1 kHz audio to decode and encode, which is nothing for
+        the jobs that only touch tags or files.
+    """
+
+    def __init__(self, planfile):
+        """
+        :param str planfile: file to write the plan to as json, or None to print it
+        """
+        self.planfile = planfile
+        self.lock = threading.Lock()
+        self.jobs = []
+
+    def add(self, kind, folder, source=None, output=None, cost=0.0):
+        """ Adds a job to the plan.
+        :param str kind: one of plan_kinds
+        :param str folder: flac or lossy folder the job is for
+        :param str source: flac file the job reads, or None
+        :param str output: lossy file the job writes or deletes, or None
+        :param float cost: estimated cost of the job
+        """
+        with self.lock:
+            self.jobs.append(PlanJob(kind, folder, source, output, cost))
+
+    def totals(self):
+        """ Sums up the plan.
+        :return dict: job kind to {'jobs': number of jobs, 'cost': total cost}
+        """
+        totals = {}
+        for job in self.jobs:
+            total = totals.setdefault(job.kind, {'jobs': 0, 'cost': 0.0})
+            total['jobs'] += 1
+            total['cost'] += job.cost
+        return totals
+
+    def show(self, jobs=True):
+        """ Prints the plan, in the order the jobs were found, and the totals for each kind.
+        :param bool jobs: print the jobs themselves, not just the totals
+        """
+        if jobs:
+            for job in self.jobs:
+                what = ' -> '.join(i for i in (job.source, job.output) if i) or job.folder
+                print "%-10s %9s  %s" % (job.kind, format_cost(job.cost) if job.cost else '', what)
+        totals = self.totals()
+        print "Plan: %d jobs, %s of audio to process" % (len(self.jobs),
+                                                         format_cost(sum(t['cost'] for t in totals.values())))
+        for kind in plan_kinds:
+            if kind in totals:
+                print "  %-10s %6d jobs  %9s" % (kind, totals[kind]['jobs'], format_cost(totals[kind]['cost']))
+
+    def write(self):
+        """ Writes the plan file.
+        """
+        with open(self.planfile, 'w') as f:
+            json.dump({'jobs': [job._asdict() for job in self.jobs], 'totals': self.totals()}, f, indent=2,
+                      sort_keys=True)
+
+
+def format_cost(cost):
+    """ Formats a cost estimate as a duration.
+    :param float cost: estimated seconds of audio
+    :return str: h:mm:ss
+    """
+    cost = int(round(cost))
+    return '%d:%02d:%02d' % (cost // 3600, cost // 60 % 60, cost % 60)
+
+
+def start_plan(planfile, simulate):
+    """ Starts recording the plan of the run, if it is a dry run or there's a plan file to write.
+    :param str planfile: file to write the plan to as json, or None
+    :param bool simulate: the run is a dry run, whose output is the plan
+    """
+    global _plan
+    if planfile or simulate:
+        _plan = RunPlan(planfile)
+
+
+def close_plan(simulate):
+    """ Writes the plan file, or prints the plan of a dry run.
+    :param bool simulate: the run was a dry run
+    """
+    global _plan
+    if _plan is not None:
+        if _plan.planfile:
+            _plan.write()
+        if simulate:
+            _plan.show(jobs=not _plan.planfile)
+    _plan = None
+
+
+class Governor(object):
+    """ Paces the run to the machine it shares.  In background mode, the number of transcodes
+        and replaygain scans running at once is cut back below -j while other processes keep
+        the CPUs busy or free memory runs short.  With a runtime budget, no new album is started
+        once it is used up.
+    """
+
+    def __init__(self, jobs, adaptive, max_runtime):
+        """
+        :param int jobs: most transcodes to run at once
+        :param bool adaptive: follow the load average and free memory
+        :param float max_runtime: seconds from now to stop starting albums, or None
+        """
+        self.jobs = jobs
+        self.adaptive = adaptive
+        self.deadline = time.time() + max_runtime if max_runtime else None
+        self.cond = threading.Condition()
+        self.running = 0
+        self.allowed = jobs
+        self.checked = 0
+        self.cpus = multiprocessing.cpu_count()
+        self.skipped = 0
+
+    def limit(self):
+        """ Works out how many transcodes may run, checking the load and memory at most once a
+            second.  Called with the lock held.
+        :return int: the limit, at least 1
+        """
+        now = time.time()
+        if not self.adaptive or now - self.checked < 1:
+            return self.allowed
+        self.checked = now
+
+        # Each running transcode keeps roughly one CPU busy, and shouldn't hold back the next
+        others = os.getloadavg()[0] - self.running
+        allowed = int(self.cpus - others)
+        available = free_memory()
+        if available is not None:
+            allowed = min(allowed, self.running + int(available // job_memory))
+        self.allowed = max(1, min(self.jobs, allowed))
+        return self.allowed
+
+    def acquire(self):
+        """ Waits until another transcode may start.
+        """
+        with self.cond:
+            while self.running >= self.limit():
+                self.cond.wait(1.0)
+            self.running += 1
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+    def out_of_time(self):
+        """ Checks the runtime budget.
+        :return bool: True once it is used up
+        """
+        return self.deadline is not None and time.time() > self.deadline
+
+
+def free_memory():
+    """ Gets the memory available for new processes without swapping.
+    :return int: bytes, or None if the kernel doesn't say
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def lower_priority():
+    """ Drops the run to a low CPU priority and the idle I/O class.  The threads and processes
+        started afterwards, the decoders and encoders among them, inherit both.
+    """
+    os.nice(10)
+    with open(os.devnull, 'w') as devnull:
+        try:
+            call(['ionice', '-c', '3', '-p', str(os.getpid())], stdout=devnull, stderr=devnull)
+        except OSError:
+            print >> sys.stderr, "ionice is not installed, keeping the normal I/O priority"
 
 
-def flacdir2lossydir(thefolder, thefiles, flacroot, lossyroot, enc_ext, encopts, force_ascii,
-                     check_rg, purge_orphaned, simulate, force_update):
-    """ Processes a single folder with FLAC files, converting it to the format requested.
+def start_governor(jobs, background, max_runtime):
+    """ Starts pacing the run, for background mode or a runtime budget.
+    :param int jobs: most transcodes to run at once
+    :param bool background: lower the priority of the run and follow the load and free memory
+    :param float max_runtime: seconds to stop starting albums after, or None
+    """
+    global _governor
+    if background:
+        lower_priority()
+    if background or max_runtime:
+        _governor = Governor(jobs, background, max_runtime)
+
+
+def close_governor():
+    """ Says what was left for the next run, if the runtime budget ran out.
+    """
+    global _governor
+    if _governor is not None and _governor.skipped:
+        print "Runtime budget used up, %d albums are left for the next run." % _governor.skipped
+    _governor = None
+
+
+@contextmanager
+def governed():
+    """ Runs the body of a with statement once the governor lets another transcode start.
+    """
+    if _governor is None:
+        yield
+        return
+    _governor.acquire()
+    try:
+        yield
+    finally:
+        _governor.release()
+
+
+class Encoder(object):
+    """ A lossy encoder that reads WAV data from stdin, and the kind of file it writes.
+    """
+
+    def __init__(self, ext, tag_format, argv):
+        """
+        :param str ext: extension of the files it writes
+        :param str tag_format: how the files are tagged, 'ogg' (vorbis comments) or 'm4a'
+        :param function argv: builds the command line from the list of encoder options
+                              and the output filename
+        """
+        self.ext = ext
+        self.tag_format = tag_format
+        self.argv = argv
+
+
+# Encoders by format name, as given to -f and -t.  ogg and m4a are the original encoders.
+encoders = {
+    'ogg': Encoder('ogg', 'ogg', lambda opts, out: ['wine', '/home/erik/bin/oggenc2.exe'] + opts +
+                                                   ['-', '-o', out]),
+    'm4a': Encoder('m4a', 'm4a', lambda opts, out: ['neroAacEnc'] + opts +
+                                                   ['-ignorelength', '-if', '-', '-of', out]),
+    'oggenc': Encoder('ogg', 'ogg', lambda opts, out: ['oggenc', '--quiet'] + opts + ['-o', out, '-']),
+    'opus': Encoder('opus', 'ogg', lambda opts, out: ['opusenc', '--quiet'] + opts + ['-', out]),
+    'fdkaac': Encoder('m4a', 'm4a', lambda opts, out: ['fdkaac', '--silent', '--ignorelength'] + opts +
+                                                      ['-o', out, '-']),
+    # The output is a .part file at first, so the container has to be given
+    'ffmpeg-aac': Encoder('m4a', 'm4a', lambda opts, out: ['ffmpeg', '-v', 'error', '-y', '-f', 'wav',
+                                                           '-i', 'pipe:0', '-vn', '-c:a', 'aac'] + opts +
+                                                          ['-f', 'ipod', out]),
+}
+
+lossy_exts = tuple(sorted(set('.' + e.ext for e in encoders.values())))
+
+
+class Target(object):
+    """ One lossy mirror to keep in sync: an encoder, its options and its root.
+    """
+
+    def __init__(self, fmt, encopts, lossyroot):
+        """
+        :param str fmt: format name, one of the keys of encoders
+        :param str encopts: encoder options to be passed to the encoder exe
+        :param str lossyroot: output root of the lossy conversion
+        """
+        self.fmt = fmt
+        self.encoder = encoders[fmt]
+        self.enc_ext = self.encoder.ext
+        self.tag_format = self.encoder.tag_format
+        self.encopts = encopts
+        self.lossyroot = lossyroot
+        self.manifest = None
+        # Output folder to the file names that belong in it, or None for all of them
+        self.expected = {}
+
+    def encoder_argv(self, newname):
+        """ Builds the encoder command line, which reads WAV data from stdin.
+        :param str newname: output filename, with path
+        :return list[str]: the command line
+        """
+        return self.encoder.argv(shlex.split(self.encopts), newname)
+
+
+def output_dir(target, thefolder, flacroot, force_ascii):
+    """ Creates the output directory name for a flac folder.
+    :param Target target: target to write to
+    :param str thefolder: flac folder
+    :param str flacroot: root of the flac tree the folder is in
+    :param bool force_ascii: convert characters in filenames to ascii
+    :return str: output directory, with path
+    """
+    outdir = os.path.join(target.lossyroot, os.path.relpath(thefolder, flacroot))
+    if force_ascii:
+        outdir = removeDisallowedFilenameChars(outdir)
+    return outdir
+
+
+def lossy_filename(flacfile, outdir, enc_ext, force_ascii):
+    """ Creates the lossy filename from the flac filename.
+    :param str flacfile: flac file, with path
+    :param str outdir: output directory
+    :param str enc_ext: extension of the lossy file
+    :param bool force_ascii: convert characters in filenames to ascii
+    :return str: lossy filename, with path
+    """
+    newname = os.path.basename(flacfile)
+    if force_ascii:
+        newname = removeDisallowedFilenameChars(newname)
+    newnamelong = os.path.join(outdir, os.path.splitext(newname)[0] + "." + enc_ext)
+    if len(newnamelong) > 256:
+        newname = os.path.join(outdir, os.path.splitext(newname)[0])
+        newname = newname[:240] + "." + enc_ext
+        print_lines(sys.stderr, "Filename too long, truncating to %s" % newname)
+    else:
+        newname = newnamelong
+    return newname
+
+
+class ArtCache(object):
+    """ Content-addressed cache of resized album art.  Entries are keyed by the hash of the
+        source image and the thumbnail size, and hold the resized jpeg along with the
+        base64 flac picture block built from it.  The least recently used entries are
+        evicted once the cache grows past its size limit.
+    """
+
+    def __init__(self, dbfile, maxbytes):
+        """
+        :param str dbfile: path of the cache database
+        :param int maxbytes: size limit for the cached art
+        """
+        self.maxbytes = maxbytes
+        # Workers of a -n run share the cache between their threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('''CREATE TABLE IF NOT EXISTS art (
+                               key TEXT PRIMARY KEY, jpeg BLOB, picture TEXT, size INTEGER, used REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS art_used ON art (used)')
+
+    def get(self, key):
+        """ Looks up cached art, marking it as recently used.
+        :param str key: source image hash and size
+        :return tuple: (resized jpeg data, base64 encoded flac picture block), or None
+        """
+        with self.lock:
+            row = self.db.execute('SELECT jpeg, picture FROM art WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE art SET used = ? WHERE key = ?', (time.time(), key))
+            # Don't hold the write lock, other runs and workers may share the cache
+            self.db.commit()
+        return str(row[0]), row[1]
+
+    def put(self, key, folderjpg, folderjpg_encoded):
+        """ Stores resized art, evicting the least recently used entries to make room.
+        :param str key: source image hash and size
+        :param str folderjpg: resized jpeg data
+        :param str folderjpg_encoded: base64 encoded flac picture block
+        """
+        size = len(folderjpg) + len(folderjpg_encoded)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO art VALUES (?, ?, ?, ?, ?)',
+                            (key, buffer(folderjpg), folderjpg_encoded, size, time.time()))
+            total = self.db.execute('SELECT SUM(size) FROM art').fetchone()[0]
+            for oldkey, oldsize in self.db.execute('SELECT key, size FROM art ORDER BY used').fetchall():
+                if total <= self.maxbytes or oldkey == key:
+                    break
+                self.db.execute('DELETE FROM art WHERE key = ?', (oldkey,))
+                total -= oldsize
+            self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def open_art_cache(cachedir, cachesize, simulate):
+    """ Opens the resized art cache.  A simulated run resizes no art, so it goes without.
+    :param str cachedir: directory for the cache, or '' for no cache
+    :param int cachesize: size limit in megabytes
+    :param bool simulate: don't create or open the cache
+    """
+    global _art_cache
+    if not cachedir or simulate:
+        return
+    cachedir = os.path.expanduser(cachedir)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    _art_cache = ArtCache(os.path.join(cachedir, 'art.db'), cachesize * 1024 * 1024)
+
+
+def close_art_cache():
+    """ Writes out and closes the resized art cache.
+    """
+    global _art_cache
+    if _art_cache is not None:
+        _art_cache.close()
+        _art_cache = None
+
+
+def make_folder_art(flacart, art_hash):
+    """ Resizes the album art for embedding, reusing an earlier resize of the same image
+        from the art cache if there is one.
+    :param str flacart: source folder.jpg
+    :param str art_hash: hex digest of the source art, from file_hash
+    :return tuple: (resized jpeg data, base64 encoded flac picture block of it, mp4 cover of it)
+    """
+    key = '%s-%dx%d' % ((art_hash,) + imsize)
+    cached = _art_cache.get(key) if _art_cache is not None else None
+    if cached is not None:
+        folderjpg, folderjpg_encoded = cached
+        return folderjpg, folderjpg_encoded, mutagen.mp4.MP4Cover(folderjpg,
+                                                                  imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)
+
+    with timed('art', os.path.dirname(flacart)):
+        im = Image.open(flacart)
+        im.thumbnail(imsize, Image.ANTIALIAS)
+        buf = StringIO()
+        im.save(buf, "JPEG", quality=95)
+    imwid, imhgt = im.size
+
+    folderjpg = buf.getvalue()
+    pict = mutagen.flac.Picture()
+    pict.data = folderjpg
+    pict.type = 3
+    pict.desc = u"Front Cover"
+    pict.mime = u"image/jpeg"
+    pict.width = imwid
+    pict.height = imhgt
+    pict.depth = 24
+
+    # get the b64 encoded data
+    picture_data = pict.write()
+    folderjpg_encoded = base64.b64encode(picture_data).decode("ascii")
+
+    if _art_cache is not None:
+        _art_cache.put(key, folderjpg, folderjpg_encoded)
+
+    return folderjpg, folderjpg_encoded, mutagen.mp4.MP4Cover(folderjpg,
+                                                              imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)
+
+
+def embed_art(lossyt, format, art):
+    """ Puts the album art into the tags of a lossy file.
+    :param mutagen.File lossyt: lossy file to tag
+    :param str format: 'ogg' or 'm4a'
+    :param tuple art: (resized jpeg data, base64 encoded flac picture block, mp4 cover) from make_folder_art
+    :return bool: True if the art was changed, so the file needs saving
+    """
+    folderjpg, folderjpg_encoded, cover = art
+    if format == 'm4a':
+        if [str(c) for c in lossyt.get('covr', [])] == [folderjpg]:
+            return False
+        lossyt['covr'] = [cover]
+    elif format == 'ogg':
+        if lossyt.get("metadata_block_picture") == [folderjpg_encoded]:
+            return False
+        lossyt["metadata_block_picture"] = [folderjpg_encoded]
+    return True
+
+
+def transcode_track(ft, outputs, art, art_hash, thefolder, flac_tagnumber, lease=None):
+    """ Transcodes a single flac file to each of its outputs and tags the results.  The flac
+        is decoded once, however many outputs there are, and the decoder and encoders are
+        timed separately for the run report.
+    :param FlacTrack ft: flac file to transcode
+    :param list[tuple] outputs: (Target, output filename with path) for each lossy file to write
+    :param tuple art: album art from make_folder_art to embed, or None
+    :param str art_hash: hash of the source art, for the manifest
+    :param str thefolder: flac folder
+    :param str flac_tagnumber: track number string, for progress output
+    :param Lease lease: lease on the job of a worker, or None
+    :return list[tuple]: the outputs that are now in place
+    """
+    enc_argvs = [target.encoder_argv(partial_name(newname, lease)) for target, newname in outputs]
+    analyzer, ok, errors = decode_to_encoders(ft.filename, enc_argvs, False, lease.lost if lease else None)
+    done = [output for output, success in zip(outputs, ok) if success]
+    for (target, newname), success, error in zip(outputs, ok, errors):
+        if not success:
+            print_failure(ft.filename, newname, error)
+            abandon_output(ft, target, newname, lease)
+
+    return tag_new_tracks(ft, done, art, art_hash, thefolder, flac_tagnumber, lease)
+
+
+def tag_new_tracks(ft, outputs, art, art_hash, thefolder, flac_tagnumber, lease=None):
+    """ Tags freshly transcoded lossy files, and renames each one into place once it is
+        complete.  Parameters and return are as for transcode_track.
+    """
+    placed = []
+    if not outputs:
+        return placed
+
+    for target, newname in outputs:
+        partial = partial_name(newname, lease)
+        # The job has been handed to another worker, which places the files itself
+        if lease is not None and lease.lost.is_set():
+            abandon_output(ft, target, newname, lease)
+            continue
+        try:
+            # set tags here
+            with timed('load', thefolder):
+                nt = mutagen.File(partial)
+            updateTags(ft, nt, target.tag_format)
+
+            # insert the artwork if we have any
+            if art:
+                embed_art(nt, target.tag_format, art)
+
+            with timed('save', thefolder):
+                nt.save(padding=tag_padding)
+            os.rename(partial, newname)
+        except Exception:
+            print_lines(sys.stderr, "Failure tagging %s" % newname,
+                        "  -  skipping file and continuing to process...")
+            abandon_output(ft, target, newname, lease)
+            continue
+
+        if _stats is not None:
+            _stats.add('encode', thefolder, bytes_written=os.path.getsize(newname), audio_seconds=ft.info.length,
+                       calls=0)
+
+        # Only the art that went into the file counts for the manifest
+        record_output(ft, target, newname, art_hash if art else None, thefolder)
+        placed.append((target, newname))
+
+    print_progress(thefolder, flac_tagnumber)
+    return placed
+
+
+def update_lossy_tags(thefolder, target, outdir, updates, art, art_hash):
+    """ Brings the tags and art of the existing lossy files of an output folder up to date.
+        Only the files whose tags or art differ are saved, and they are done in file name
+        order, so the writes of a folder stay together on the disk.
+    :param str thefolder: flac folder
+    :param Target target: target the folder belongs to
+    :param str outdir: output folder
+    :param list[tuple] updates: (FlacTrack, LossyTrack, True if the tags need checking) for each
+                                lossy file of the folder
+    :param tuple art: album art from make_folder_art to embed, or None to leave the art alone
+    :param str art_hash: hash of the source art, for the manifest
+    """
+    saved = 0
+    for ft, lossyrec, stale in sorted(updates, key=lambda u: u[1].filename):
+        saveit = False
+        lossyt = None
+        if stale or art:
+            with timed('load', thefolder):
+                lossyt = mutagen.File(lossyrec.filename)
+        if stale:
+            saveit = updateTags(ft, lossyt, target.tag_format)
+
+        # Update image if this target needs it
+        if art:
+            saveit = embed_art(lossyt, target.tag_format, art) or saveit
+
+        if saveit:
+            try:
+                with timed('save', thefolder):
+                    lossyt.save(padding=tag_padding)
+                saved += 1
+            except Exception:
+                print_lines(sys.stderr, "Failure updating tags for file %s" % lossyrec.filename,
+                            "  -  skipping file and continuing to process...")
+                continue
+
+        if saveit or stale:
+            # Update the timestamp on the lossy file, so an unchanged file isn't checked again
+            os.utime(lossyrec.filename, None)
+        del lossyt
+
+        if target.manifest is not None:
+            target.manifest.record_track(ft.filename, thefolder, tag_hash(ft),
+                                         art_hash if art or lossyrec.has_art else None,
+                                         lossyrec.filename, target.enc_ext, target.encopts, audio_id(ft))
+
+    if saved:
+        print_lines(sys.stdout, "Updated the tags of %d of %d files in %s" % (saved, len(updates), outdir))
+
+
+def record_output(ft, target, newname, art_hash, thefolder):
+    """ Records a new lossy file in the manifest, and closes its journal entry.
+    :param FlacTrack ft: flac file it was transcoded from
+    :param Target target: target of the output
+    :param str newname: output filename, with path
+    :param str art_hash: hash of the source art
+    :param str thefolder: flac folder
+    """
+    if target.manifest is not None:
+        target.manifest.record_track(ft.filename, thefolder, tag_hash(ft), art_hash, newname,
+                                     target.enc_ext, target.encopts, audio_id(ft))
+        target.manifest.finish_job(ft.filename, target.enc_ext)
+
+
+def partial_name(newname, lease=None):
+    """ Gets the name a lossy file is written under until it is transcoded and tagged, so
+        an interrupted run never leaves a truncated file under the real name.  A worker's
+        files are named after its lease, so a worker that lost the lease on a job never
+        writes to the files of the one it was handed to next.
+    :param str newname: output filename, with path
+    :param Lease lease: lease on the job of a worker, or None
+    :return str: temporary filename, with path
+    """
+    if lease is not None:
+        return '%s.%s.part' % (newname, lease.token)
+    return newname + '.part'
+
+
+def journal_outputs(ft, outputs, thefolder):
+    """ Journals the transcodes of a track before they start.
+    :param FlacTrack ft: flac file to transcode
+    :param list[tuple] outputs: (Target, output filename with path) for each lossy file to write
+    :param str thefolder: flac folder
+    """
+    for target, newname in outputs:
+        if target.manifest is not None:
+            target.manifest.journal_job(ft.filename, thefolder, newname, target.enc_ext)
+
+
+def abandon_output(ft, target, newname, lease=None):
+    """ Cleans up after a transcode that failed, so nothing of it is kept.
+    :param FlacTrack ft: flac file that was being transcoded
+    :param Target target: target of the output
+    :param str newname: output filename, with path
+    :param Lease lease: lease on the job of a worker, or None
+    """
+    try:
+        os.remove(partial_name(newname, lease))
+    except OSError:
+        pass
+    if target.manifest is not None:
+        target.manifest.finish_job(ft.filename, target.enc_ext)
+
+
+def find_output(flac_file, target, outdir, force_ascii, thefolder):
+    """ Finds the lossy file of a flac in an up to date output folder the manifest doesn't know.
+    :param str flac_file: flac file, with path
+    :param Target target: target of the output folder
+    :param str outdir: output folder
+    :param bool force_ascii: convert characters in filenames to ascii
+    :param str thefolder: flac folder
+    :return tuple: (lossy file with path, audio_id of the flac), or (None, None) if it isn't there
+    """
+    output = lossy_filename(flac_file, outdir, target.enc_ext, force_ascii)
+    if _tree.stat(output) is None:
+        return None, None
+    with timed('load', thefolder):
+        ft = read_flac(flac_file)
+    return output, audio_id(ft)
+
+
+def find_relocation(ft, target, newname):
+    """ Looks in the manifest for a lossy file made from the same audio as a flac that was
+        renamed or moved.
+    :param FlacTrack ft: flac file that has no lossy file yet
+    :param Target target: target to find the lossy file in
+    :param str newname: output filename, with path
+    :return tuple: (old flac file, lossy file) of the match, or None
+    """
+    ident = audio_id(ft)
+    if ident is None or target.manifest is None:
+        return None
+
+    for source, output in target.manifest.find_audio(ident, target.enc_ext, target.encopts):
+        if source == ft.filename or output == newname or not os.path.isfile(output):
+            continue
+        return source, output
+
+    return None
+
+
+def relocate_output(ft, target, newname):
+    """ Moves the lossy file found by find_relocation to the flac's new output name.  If the
+        old flac is still there, the lossy file is copied instead.  Parameters are as for
+        find_relocation.
+    :return bool: True if the lossy file is now in place
+    """
+    found = find_relocation(ft, target, newname)
+    if found is None:
+        return False
+    source, output = found
+
+    olddir = os.path.dirname(output)
+    try:
+        if os.path.exists(source):
+            print_lines(sys.stdout, "Copying %s to %s ..." % (output, newname))
+            shutil.copy2(output, newname)
+        else:
+            print_lines(sys.stdout, "Moving %s to %s ..." % (output, newname))
+            shutil.move(output, newname)
+            target.manifest.forget_track(source, target.enc_ext)
+
+            # Tidy up the old folder once its last track has moved
+            remaining = os.listdir(olddir)
+            if not any(i.endswith(lossy_exts) for i in remaining):
+                for i in remaining:
+                    if i in ("folder.jpg", "flac.exists"):
+                        os.remove(os.path.join(olddir, i))
+                try:
+                    os.removedirs(olddir)
+                except OSError:
+                    pass
+    except (IOError, OSError):
+        print_lines(sys.stderr, "Failure relocating %s to %s" % (output, newname), "  -  transcoding instead...")
+        return False
+    finally:
+        _tree.forget(olddir)
+    return True
+
+
+def expected_names(outputs):
+    """ Gets the file names that belong in an output folder from its manifest outputs.
+    :param dict outputs: flac file to (lossy file, audio_id), from SyncManifest.folder_outputs
+    :return set[str]: file names, no paths, or None if any lossy file is not known
+    """
+    if not outputs or any(output is None for output, audio in outputs.values()):
+        return None
+    return set(os.path.basename(output) for output, audio in outputs.values()) | {'folder.jpg'}
+
+
+def expect_outputs(target, outdir, names):
+    """ Records the files that belong in an output folder, so dir_purge keeps them.
+    :param Target target: target the folder belongs to
+    :param str outdir: output folder
+    :param set[str] names: file names, no paths, or None to keep every file in the folder
+    """
+    outdir = os.path.normpath(outdir)
+    if names is None or target.expected.get(outdir, set()) is None:
+        target.expected[outdir] = None
+    else:
+        target.expected.setdefault(outdir, set()).update(names)
+
+
+def prepare_folder(thefolder, thefiles, flacroot, targets, force_ascii, force_update, use_manifest, load=True):
+    """ Works out which of the targets a folder is out of date for, and reads the flacs and the
+        existing lossy files of the ones that are.  Nothing is changed, so this can run ahead of
+        the folders still being synced.
+    :param str thefolder: flac folder
+    :param list[str] thefiles: list of files in this directory, no paths
+    :param str flacroot: root of the flac conversion, for relative path determination
+    :param list[Target] targets: lossy formats and roots to write
+    :param bool force_ascii: convert characters in filenames to ascii
+    :param bool force_update: force a tag update on all lossy files
+    :param bool use_manifest: skip folders the manifest shows as unchanged
+    :param bool load: read the files, False to only check the folder
+    :return FolderPrep: what flacdir2lossydir needs to know of the folder
+    """
+    input_files = [os.path.join(thefolder, thefile) for thefile in thefiles]
+    flac_files = [input_file for input_file in input_files if input_file.endswith('.flac')]
+    flacart = None if 'folder.jpg' not in thefiles else os.path.join(thefolder, 'folder.jpg')
+
+    outdirs = {}
+    current = {}
+    pending = []
+    with timed('check', thefolder):
+        for target in targets:
+            outdir = outdirs[target] = output_dir(target, thefolder, flacroot, force_ascii)
+
+            # The manifest can confirm an unchanged folder from stats alone
+            if not force_update and use_manifest and target.manifest is not None and _tree.isdir(outdir) and \
+                    target.manifest.folder_is_current(thefolder, flac_files, flacart, target.enc_ext,
+                                                      target.encopts):
+                current[target] = True
+            elif not force_update and not does_dir_need_update(outdir, target.enc_ext, input_files):
+                current[target] = False
+            else:
+                pending.append(target)
+
+    if not pending or not load:
+        return FolderPrep(outdirs, current, pending, None, None, None)
+
+    # Read the stream info and tags of the flacs, leaving out their pictures.  Of the lossy files
+    # only the track number and art of each is kept, the tags are loaded again to change them.
+    with timed('load', thefolder):
+        flactags = [read_flac(input_file) for input_file in sorted(flac_files)]
+        lossytags = {}
+        for target in pending:
+            entries = _tree.listing(outdirs[target]) or {}
+            lossytags[target] = [LossyTrack(os.path.join(outdirs[target], i), target.tag_format)
+                                 for i in entries if i.endswith("." + target.enc_ext)]
+    art_hash = file_hash(flacart) if flacart else None
+    return FolderPrep(outdirs, current, pending, flactags, lossytags, art_hash)
+
+
+def flacdir2lossydir(thefolder, thefiles, flacroot, targets, force_ascii, check_rg, purge_orphaned,
+                     simulate, force_update, use_manifest, fused_rg, tags_only):
+    """ Processes a single folder with FLAC files, converting it to each of the targets.  Tags,
+        art and replaygain are worked out once and shared by all of the targets.
     :param str thefolder: current work folder
     :param list[str] thefiles: list of files in this directory, no paths
     :param str flacroot: root of the flac conversion, for relative path determination
-    :param str lossyroot: output root of the lossy conversion
-    :param str enc_ext: 'ogg' or 'm4a'
-    :param str encopts: encoder options to be passed to the encoder exe
+    :param list[Target] targets: lossy formats and roots to write
     :param bool force_ascii: convert characters in filenames to ascii
     :param bool check_rg: check the input flac files for albumgain, add it if missing
-    :param bool purge_orphaned: mark folders that were touched with flac.exists files
+    :param bool purge_orphaned: record the expected output files for dir_purge
     :param bool simulate: don't do anything, just simulate
     :param bool force_update: force a tag update on all lossy files
+    :param bool use_manifest: skip folders the manifest shows as unchanged
+    :param bool fused_rg: compute missing replaygain while transcoding instead of with metaflac
+    :param bool tags_only: only bring the tags and art of the existing lossy files up to date
     """
-    # Create the output directory name
-    outdir = os.path.join(lossyroot, os.path.relpath(thefolder, flacroot))
-    if force_ascii:
-        outdir = removeDisallowedFilenameChars(outdir)
-
     input_files = [os.path.join(thefolder, thefile) for thefile in thefiles]
     flac_files = [input_file for input_file in input_files if input_file.endswith('.flac')]
 
     if len(flac_files) == 0:
         return
 
-    if not force_update and not does_dir_need_update(outdir, enc_ext, input_files):
+    flacart = None if 'folder.jpg' not in thefiles else os.path.join(thefolder, 'folder.jpg')
+
+    if _stats is not None:
+        _stats.visit(len(flac_files))
+
+    # Work out which of the targets are out of date, unless the read-ahead already has.  Past the
+    # runtime budget nothing is read, as the folder won't be synced anyway.
+    prep = _reader.take(thefolder, thefiles) if _reader is not None else None
+    if prep is None:
+        prep = prepare_folder(thefolder, thefiles, flacroot, targets, force_ascii, force_update, use_manifest,
+                              _governor is None or not _governor.out_of_time())
+    outdirs = prep.outdirs
+    pending = prep.pending
+    art_hash = prep.art_hash
+
+    for target in targets:
+        if target in pending:
+            continue
+        outdir = outdirs[target]
+
+        # The manifest confirmed an unchanged folder without touching the output dir
+        if prep.current[target]:
+            if purge_orphaned:
+                outputs = target.manifest.folder_outputs(thefolder, target.enc_ext, flac_files)
+                expect_outputs(target, outdir, expected_names(outputs))
+            continue
+
+        # Carry over the lossy files the manifest already knows for the remaining flacs, and look up
+        # the ones it doesn't, as for a mirror made before the manifest, so the next run can rely on it
+        outputs = {}
+        if target.manifest is not None:
+            outputs = target.manifest.folder_outputs(thefolder, target.enc_ext, flac_files)
+            for flac_file, (output, audio) in outputs.items():
+                if output is None:
+                    outputs[flac_file] = find_output(flac_file, target, outdir, force_ascii, thefolder)
+        if target.manifest is not None and not simulate:
+            target.manifest.forget_folder(thefolder, target.enc_ext)
+            if flacart:
+                art_hash = art_hash or file_hash(flacart)
+                target.manifest.record_art(flacart, art_hash)
+            for flac_file in flac_files:
+                output, audio = outputs[flac_file]
+                target.manifest.record_track(flac_file, thefolder, None, art_hash, output,
+                                             target.enc_ext, target.encopts, audio)
+            target.manifest.commit()
         if purge_orphaned:
-            open(os.path.join(outdir, "flac.exists"), 'w').close()
+            expect_outputs(target, outdir, expected_names(outputs))
+
+    if not pending:
         return
 
-    # Load the flac tag structures into a list of mutagen.File objects
-    flactags = [mutagen.File(input_file) for input_file in sorted(flac_files)]
-    flacart = None if 'folder.jpg' not in thefiles else os.path.join(thefolder, 'folder.jpg')
+    # Past the runtime budget, the album is left as it is for the next run
+    if prep.flactags is None or _governor is not None and _governor.out_of_time():
+        if _governor is not None:
+            _governor.skipped += 1
+        if purge_orphaned:
+            for target in pending:
+                expect_outputs(target, outdirs[target], None)
+        return
 
-    if check_rg:
+    flactags = prep.flactags
+
+    # Missing replaygain is added first, or with -g computed during the transcode further down
+    add_rg = check_rg and not tags_only and needs_rg(flactags)
+    fuse_rg = add_rg and fused_rg and can_fuse_rg(flactags)
+    if add_rg and _plan is not None:
+        _plan.add('replaygain', thefolder, cost=sum(track_cost(ft) for ft in flactags))
+    if add_rg and not fuse_rg and not simulate:
         apply_rg_to_flacs(flactags, thefolder)
-        # Re-open the flac files to get the new tags
-        flactags = [mutagen.File(i.filename) for i in flactags]
-       
-    set_album_artist_tags(flactags)
+        # Re-read the flac files to get the new tags
+        with timed('load', thefolder):
+            flactags = [read_flac(i.filename) for i in flactags]
+        _tree.forget(thefolder)
 
-    # Simulating means we can stop here
-    if simulate:
+    if any(ft.tracknumber is None for ft in flactags):
+        print_lines(sys.stdout, "Unable to parse tracknumber tag for files in %s, skipping dir..." % thefolder)
         if purge_orphaned:
-            open(os.path.join(outdir, "flac.exists"), "w").close()
+            for target in pending:
+                expect_outputs(target, outdirs[target], None)
         return
 
-    # Check to see if the dir exists
-    if not os.path.isdir(outdir):
-        try:
-            os.makedirs(outdir)
-        except Exception:
-            print >> sys.stderr, "Failure to create the folder %s", outdir
-            print >> sys.stderr, "  -  skipping folder and continuing to process..."
+    if not simulate:
+        # Check to see if the dirs exist
+        for target in list(pending):
+            if not _tree.isdir(outdirs[target]):
+                try:
+                    os.makedirs(outdirs[target])
+                    _tree.forget(os.path.dirname(outdirs[target]))
+                except Exception:
+                    print_lines(sys.stderr, "Failure to create the folder %s" % outdirs[target],
+                                "  -  skipping folder and continuing to process...")
+                    pending.remove(target)
+        if not pending:
             return
 
-    # Get a list of the files in the lossy directory
-    odirfiles = os.listdir(outdir)
-    
-    lossytags = [mutagen.File(os.path.join(outdir, i)) for i in odirfiles
-                 if i.endswith("." + enc_ext)]
-               
-    # Make a mapping of track number to lossy file
-    lossydict = {}
-    for lt in lossytags:
-        tn = getTracknumberStr(lt, enc_ext)
-        if tn is None:
-            # delete lossy files with bad tags or without tags
-            os.unlink(lt.filename)
-        else:
-            lossydict[tn] = lt
+        for target in pending:
+            if target.manifest is not None:
+                target.manifest.forget_folder(thefolder, target.enc_ext)
+                if flacart:
+                    target.manifest.record_art(flacart, art_hash)
+
+    odirfiles = {}
+    lossytags = {}
+    lossydicts = {}
+    for target in pending:
+        # Get a list of the files in the lossy directory
+        odirfiles[target] = _tree.listing(outdirs[target]) or {}
+        # Files moved away by the relocations of the folders synced since this one was read are dropped
+        lossytags[target] = [lt for lt in prep.lossytags[target]
+                             if os.path.basename(lt.filename) in odirfiles[target]]
+
+        # Make a mapping of track number to lossy file
+        lossydict = lossydicts[target] = {}
+        for lt in lossytags[target]:
+            if lt.tracknumber is None:
+                # delete lossy files with bad tags or without tags
+                if _plan is not None:
+                    _plan.add('purge', thefolder, output=lt.filename)
+                if not simulate:
+                    os.unlink(lt.filename)
+            else:
+                lossydict[lt.tracknumber] = lt
+
+    # Move lossy files whose flac was renamed or moved, rather than transcoding them again
+    relocated = set()
+    for target in pending:
+        moved = False
+        for ft in flactags:
+            if tags_only or ft.tracknumber in lossydicts[target]:
+                continue
+            newname = lossy_filename(ft.filename, outdirs[target], target.enc_ext, force_ascii)
+            if simulate:
+                found = find_relocation(ft, target, newname)
+                if found is not None:
+                    if _plan is not None:
+                        _plan.add('relocate', thefolder, found[1], newname)
+                    relocated.add(newname)
+            elif relocate_output(ft, target, newname):
+                lossydicts[target][ft.tracknumber] = LossyTrack(newname, target.tag_format)
+                lossytags[target].append(lossydicts[target][ft.tracknumber])
+                relocated.add(newname)
+                moved = True
+        if moved:
+            _tree.forget(outdirs[target])
+            odirfiles[target] = _tree.listing(outdirs[target]) or {}
+
+    # Lossy files of tracks that are still in the folder are kept by the purge
+    flac_tns = set(ft.tracknumber for ft in flactags)
+    keep = {}
+    for target in pending:
+        keep[target] = set(['folder.jpg'])
+        keep[target].update(os.path.basename(lt.filename) for tn, lt in lossydicts[target].items()
+                            if tn in flac_tns)
 
     # Get the time of the source artwork
     flactime = 0
     if flacart:
-        flactime = os.path.getmtime(flacart)
-
-    # Get the time of the destination artwork
-    lossytime = 0
-    lossyart = os.path.join(outdir, 'folder.jpg')
-    if 'folder.jpg' in odirfiles:
-        lossytime = os.path.getmtime(lossyart)
+        flactime = _tree.stat(flacart).mtime
 
-    folderjpg = None
     # Do we need to update the artwork in the files?
-    if flactime > 0 and (lossytime < flactime or force_update or
-                         (len(lossytags) > 0 and 'covr' not in lossytags[0] and
-                          'metadata_block_picture' not in lossytags[0])):
+    refresh_art = {}
+    for target in pending:
+        # Get the time of the destination artwork
+        lossytime = 0
+        if 'folder.jpg' in odirfiles[target]:
+            lossytime = odirfiles[target]['folder.jpg'].mtime
+        tags = lossytags[target]
+        refresh_art[target] = flactime > 0 and (lossytime < flactime or force_update or
+                                                any(not lt.has_art for lt in tags))
+
+    # Plan the work on each track: the lossy files it has to check the tags or art of, and the
+    # ones it needs transcoding to
+    tracks = []
+    for ft in flactags:
+        updates = []
+        outputs = []
+        for target in pending:
+            lossyrec = lossydicts[target].get(ft.tracknumber, None)
+            if lossyrec:
+                # check time stamps on the flac and lossy files
+                # if the flac file is newer, update the tags in the lossy file
+                lossytime = odirfiles[target][os.path.basename(lossyrec.filename)].mtime
+
+                # Check the tags if flac was updated for any reason, or the lossy file was moved here
+                stale = lossytime < ft.mtime or force_update or lossyrec.filename in relocated or add_rg
+                updates.append((target, lossyrec, stale))
+            else:
+                # create the lossy filename from the flac filename
+                newname = lossy_filename(ft.filename, outdirs[target], target.enc_ext, force_ascii)
+                keep[target].add(os.path.basename(newname))
+                if newname not in relocated and not tags_only:
+                    outputs.append((target, newname))
+        tracks.append((ft, updates, outputs))
+
+    if _plan is not None:
+        for ft, updates, outputs in tracks:
+            for target, lossyrec, stale in updates:
+                if stale:
+                    _plan.add('retag', thefolder, ft.filename, lossyrec.filename)
+                if refresh_art[target]:
+                    _plan.add('art', thefolder, ft.filename, lossyrec.filename)
+            for target, newname in outputs:
+                _plan.add('transcode', thefolder, ft.filename, newname, track_cost(ft))
 
-        # Resize the folder.jpg art and write to output dir
-        im = Image.open(flacart)
-        im.thumbnail(imsize, Image.ANTIALIAS)
-        im.save(lossyart, "JPEG", quality=95)
-        imwid, imhgt = im.size
-        
-        # Read the art file into a string to be put into the tags
-        if os.path.exists(lossyart):
-            with open(lossyart, 'rb') as albumArt:
-                folderjpg = albumArt.read()
-            pict = mutagen.flac.Picture()
-            pict.data = folderjpg
-            pict.type = 3
-            pict.desc = u"Front Cover"
-            pict.mime = u"image/jpeg"
-            pict.width = imwid
-            pict.height = imhgt
-            pict.depth = 24
-
-            # get the b64 encoded data
-            picture_data = pict.write()
-            folderjpg_encoded = base64.b64encode(picture_data).decode("ascii")
+    # Simulating means we can stop here
+    if simulate:
+        if purge_orphaned:
+            for target in pending:
+                expect_outputs(target, outdirs[target], keep[target])
+        return
 
+    formats = ', '.join(target.enc_ext for target in pending)
     printed = False
-    # Loop over the flac files
-    for ft in flactags:
-    
-        flac_tagnumber = getTracknumberStr(ft, 'flac')
-       
-        if not flac_tagnumber:
-            print "Unable to parse tracknumber tag for files in %s, skipping dir..." % thefolder
-            return
-    
-        lossyt = lossydict.get(flac_tagnumber, None)
-
-        # If the ogg exists, update the tags
-        if lossyt:
-            # check time stamps on the flac and lossy files
-            # if the flac file is newer, update the tags in the lossy file
-            flactime = os.path.getmtime(ft.filename)
-            lossytime = os.path.getmtime(lossyt.filename)
-          
-            saveit = False
-            # Update tags if flac was updated for any reason
-            if lossytime < flactime or force_update:
-                updateTags(ft, lossyt, enc_ext)
-                saveit = True
-
-            # Update image if we loaded it earlier
-            if folderjpg:
-                if enc_ext== 'm4a':
-                    lossyt['covr'] = [mutagen.mp4.MP4Cover(folderjpg, imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
-                elif enc_ext== 'ogg':
-                    lossyt["metadata_block_picture"] = [folderjpg_encoded]
-                saveit = True
-          
-            if saveit:
-                if not printed:
-                    print "Converting flacs in %s to %s..." % (thefolder, enc_ext)
-                    printed = True
-
-                print flac_tagnumber, "...",
-                sys.stdout.flush()
-                try:
-                    lossyt.save()
-                except Exception:
-                    print >> sys.stderr, "Failure updating tags for file %s" % lossyt.filename
-                    print >> sys.stderr, "  -  skipping file and continuing to process..."
-                    continue
-                # Update the timestamp on the lossy file
-                os.utime(lossyt.filename, None)
-       
-        else:  # Create the transcoded file and tag it
-       
-            # create the lossy filename from the flac filename
-            newname = os.path.basename(ft.filename)
-            if force_ascii:
-                newname = removeDisallowedFilenameChars(newname)
-            newnamelong = os.path.join(outdir, os.path.splitext(newname)[0] + "." + enc_ext)
-            if len(newnamelong) > 256:
-                newname = os.path.join(outdir, os.path.splitext(newname)[0])
-                newname = newname[:240] + "." + enc_ext
-                print >> sys.stderr, "Filename too long, truncating to %s" % newname
-            else:
-                newname = newnamelong
-
-            # transcode here
-            if enc_ext== 'ogg':
-                transcode_cmd = 'flac --totally-silent -d -c "%s" | wine /home/erik/bin/oggenc2.exe %s - -o "%s" > /dev/null 2>&1' % (ft.filename, encopts, newname)
-            else:  # enc_ext== 'm4a':
-                transcode_cmd = 'flac --totally-silent -d -c "%s" | neroAacEnc %s -ignorelength -if - -of "%s" > /dev/null 2>&1' % (ft.filename, encopts, newname)
-          
-            if not printed:
-                print "Converting flacs in %s to %s..." % (thefolder, enc_ext)
-                printed = True
-
-            print flac_tagnumber,"...",
-            sys.stdout.flush()
-          
-            try:
-                retcode = call(transcode_cmd, shell=True)
-                if retcode < 0:
-                    print >> sys.stderr, "Failure converting %s to %s" % (ft.filename, newname)
-                    print >> sys.stderr, "  -  skipping file and continuing to process..."
-                    continue
-            except Exception:
-                print >> sys.stderr, "Failure converting %s to %s" % (ft.filename, newname)
-                print >> sys.stderr, "  -  skipping file and continuing to process..."
-                continue
-             
-            # set tags here
-            nt = mutagen.File(newname)
-            updateTags(ft, nt, enc_ext)
-          
-            # insert the artwork if we have any
-            if folderjpg:
-                if enc_ext == 'm4a':
-                    nt['covr'] = [mutagen.mp4.MP4Cover(folderjpg, imageformat=mutagen.mp4.MP4Cover.FORMAT_JPEG)]
-                elif enc_ext == 'ogg':
-                    nt["metadata_block_picture"] = [folderjpg_encoded]
-          
-            nt.save()
-
-    if printed:
-        print
-    
-    if purge_orphaned:
-        open(os.path.join(outdir, "flac.exists"), "w").close()
 
+    fused_outputs = None
+    if fuse_rg:
+        new_outputs = dict((ft.filename, outputs) for ft, updates, outputs in tracks)
+        for ft, updates, outputs in tracks:
+            journal_outputs(ft, outputs, thefolder)
+        print_lines(sys.stdout, "Transcoding and replaygaining flacs in %s..." % thefolder)
+        # The new replaygain tags are set on the tracks as they are written to the flacs
+        fused_outputs = fused_rg_album(flactags, new_outputs, thefolder)
+        _tree.forget(thefolder)
 
-def dir_purge(thefolder, thefiles, *a, **k):
+    set_album_artist_tags(flactags)
+
+    # New lossy files always get the art.  An up to date folder.jpg only says the existing ones
+    # have it, as a run interrupted after writing it may not have placed the rest.
+    art = None
+    if flacart and (any(refresh_art.values()) or any(outputs for ft, updates, outputs in tracks)):
+        # Resize the folder.jpg art and write to the output dirs that need it
+        art = make_folder_art(flacart, art_hash)
+        for target in pending:
+            if refresh_art[target]:
+                with open(os.path.join(outdirs[target], 'folder.jpg'), 'wb') as albumArt:
+                    albumArt.write(art[0])
+
+    # Run the plan.  The existing lossy files of each output folder are updated as a batch on the
+    # tag pool, and the new ones are transcoded.
+    for target in pending:
+        batch = [(ft, lossyrec, stale) for ft, updates, outputs in tracks
+                 for t, lossyrec, stale in updates if t is target]
+        if batch:
+            submit_tag_job(update_lossy_tags, thefolder, target, outdirs[target], batch,
+                           art if refresh_art[target] else None, art_hash)
+
+    transcodes = []
+    for ft, updates, outputs in tracks:
+        flac_tagnumber = ft.tracknumber
+
+        if not outputs:
+            continue
+
+        if not printed:
+            print_lines(sys.stdout, "Converting flacs in %s to %s..." % (thefolder, formats))
+            printed = True
+
+        # Already transcoded while computing the replaygain
+        if fused_outputs is not None:
+            tag_new_tracks(ft, fused_outputs.get(ft.filename, []), art, art_hash, thefolder, flac_tagnumber)
+            continue
+
+        transcodes.append((track_cost(ft) * len(outputs), ft, outputs))
+
+    # Longest tracks first on the workers, so they aren't left waiting on one long track at the end
+    if _pool is not None:
+        transcodes.sort(key=lambda t: -t[0])
+    for cost, ft, outputs in transcodes:
+        journal_outputs(ft, outputs, thefolder)
+        if _jobserver is not None:
+            publish_transcode(ft, outputs, flacart if art else None, art_hash, thefolder, cost)
+        else:
+            submit_job(cost, transcode_track, ft, outputs, art, art_hash, thefolder, ft.tracknumber)
+
+    if printed and _pool is None and _jobserver is None:
+        print_lines(sys.stdout, '')
+
+    for target in pending:
+        _tree.forget(outdirs[target])
+
+        if target.manifest is not None:
+            target.manifest.commit()
+
+        if purge_orphaned:
+            expect_outputs(target, outdirs[target], keep[target])
+
+
+def dir_purge(thefolder, thefiles, expected, simulate, **k):
+    """ Deletes the lossy files and folders that no longer have a flac source.
+    :param str thefolder: current lossy folder
+    :param list[str] thefiles: list of files in this directory, no paths
+    :param dict expected: output folder to the file names that belong in it, or None for all
+    :param bool simulate: don't delete anything, just say what would go
+    """
+    # Placeholders left by older versions of this script
+    if "flac.exists" in thefiles:
+        if not simulate:
+            os.remove(os.path.join(thefolder, "flac.exists"))
+        thefiles = [i for i in thefiles if i != "flac.exists"]
+
+    # Partial outputs of an interrupted run, see partial_name
+    for i in [i for i in thefiles if i.endswith(".part")]:
+        print_lines(sys.stdout, "Deleting %s ..." % os.path.join(thefolder, i))
+        if _plan is not None:
+            _plan.add('purge', thefolder, output=os.path.join(thefolder, i))
+        if not simulate:
+            os.remove(os.path.join(thefolder, i))
+    thefiles = [i for i in thefiles if not i.endswith(".part")]
+
+    audios = [i for i in sorted(thefiles) if i.endswith(lossy_exts)]
 
-    # Load the transcoded tag structures into a list of mutagen.File objects
-    audios = [i for i in sorted(thefiles) if (i.endswith(".ogg") or i.endswith(".m4a"))]
-    
     if not audios:
         return
 
-    if "flac.exists" in sorted(thefiles):
-        os.remove(os.path.join(thefolder, "flac.exists"))
+    folder = os.path.normpath(thefolder)
+    if folder in expected:
+        # Get rid of the files of tracks that are gone from the flac folder
+        names = expected[folder]
+        if names is None:
+            return
+        for i in audios:
+            if i not in names:
+                print_lines(sys.stdout, "Deleting %s ..." % os.path.join(thefolder, i))
+                if _plan is not None:
+                    _plan.add('purge', thefolder, output=os.path.join(thefolder, i))
+                if not simulate:
+                    os.remove(os.path.join(thefolder, i))
         return
 
     # Get rid of all of the files    
-    print "Deleting %s ..." % thefolder
+    print_lines(sys.stdout, "Deleting %s ..." % thefolder)
+    if _plan is not None:
+        _plan.add('purge', thefolder)
 
-    if not k['simulate']:
+    # A parent folder may have been deleted already
+    if not simulate and os.path.isdir(thefolder):
         for i in thefiles:
-            os.remove(os.path.join(thefolder, i))
+            if i != manifest_name:
+                os.remove(os.path.join(thefolder, i))
 
-        os.removedirs(thefolder)
+        if manifest_name not in thefiles:
+            os.removedirs(thefolder)
 
                              
 def get_options():
-    p = optparse.OptionParser(usage="usage: %prog [options] flacrootdir lossyrootdir",
+    p = optparse.OptionParser(usage="usage: %prog [options] flacrootdir lossyrootdir\n"
+                                    "       %prog [options] -t format:lossyrootdir[:encopts] ... flacrootdir",
                               description='''This script creates a lossy mirror of a flac directory tree,
                                              recursively. Album art (named folder.jpg) will be resized to
                                              240x240 resolution and will be embedded in the tags & copied.''')
 
     p.add_option('-f', action='store', dest='enc_ext',
-                 help='Lossy format to use. ogg and m4a are currently supported.')
+                 help='''Lossy format to use: ogg (oggenc2 under wine), m4a (neroAacEnc),
+                     oggenc, opus (opusenc), fdkaac or ffmpeg-aac.  The encoders
+                     are run directly, without a shell.''')
 
     p.add_option('-o', action='store', dest='encopts', default='',
                  help='Option string to pass to the encoder.')
 
+    p.add_option('-t', action='append', dest='targets', metavar='FORMAT:LOSSYROOT[:ENCOPTS]',
+                 help='''Add an output target, instead of using -f, -o and the last
+                     directory argument.  Give -t once per mirror to keep, e.g.
+                     -t ogg:/mnt/phone:-q5 -t m4a:/mnt/car.  Each flac is decoded
+                     once and fed to all of the encoders that need it, and all
+                     directory arguments are flac roots.''')
+
     p.add_option('-a', action='store_false', dest='force_ascii', default=True,
                  help='''Depending on the operating system, certain characters
                      may be illegal for use in filenames.  Additionally, accent
@@ -459,42 +2764,733 @@ def get_options():
 
     p.add_option('-k', action='store_false', dest='purge_orphaned', default=True,
                  help='''By default, as the flac directory tree is traversed,
-                     this script will put a small placeholder file in 'touched' 
-                     directories.  When the tree traversals is complete, the script
-                     will then walk the lossy tree ensuring that each directory with
-                     audio files in it has this placeholder, otherwise it will delete
-                     the directory as orphaned.  Specifying -k (keep) skips this
-                     check and leaves all directories in the lossy tree intact.''')
+                     this script keeps track of the lossy files each flac directory
+                     should have.  When the tree traversal is complete, the script
+                     will then walk the lossy tree, deleting directories with audio
+                     files that have no flac directory, and audio files of tracks
+                     that are gone from their flac directory.  Specifying -k (keep)
+                     skips this check and leaves the lossy tree intact.''')
+
+    p.add_option('-g', action='store_true', dest='fused_rg', default=False,
+                 help='''When replaygain tags are missing, compute them while transcoding
+                     instead of running metaflac first, so each flac is decoded only
+                     once.  The tags are written back to the flacs when the folder is
+                     done.  Requires numpy and scipy, and 44.1 or 48 kHz mono/stereo
+                     flacs; other folders fall back to metaflac.''')
+
+    p.add_option('-c', action='store', dest='art_cache', default='~/.cache/f2l', metavar='DIR',
+                 help='''Directory for the cache of resized album art, shared by all
+                     runs and targets.  Albums that use the same cover, and repeated
+                     -u runs, reuse the cached resize instead of redoing it.  Give
+                     an empty string to disable the cache.  Defaults to %default.''')
+
+    p.add_option('-z', action='store', dest='art_cache_size', type='int', default=64, metavar='MB',
+                 help='''Size limit of the album art cache in megabytes.  The least
+                     recently used art is dropped beyond this.  Defaults to %default.''')
+
+    p.add_option('-y', action='store_true', dest='tags_only', default=False,
+                 help='''Metadata sync.  Only bring the tags and art of the lossy files
+                     that already exist up to date, for after a retag of the flacs.
+                     Nothing is transcoded, replaygained or moved.''')
 
     p.add_option('-s', action='store_true', dest='simulate', default=False,
-                 help='''Simulate mode.  Generate the dirs, convert art, but do no
-                     format conversion.  Don't delete anything, just indicate what will
-                     happen.''')
+                 help='''Simulate mode.  Nothing is written, transcoded or deleted.
+                     Instead the plan of the run is printed: the replaygain,
+                     transcode, relocate, retag, art and purge jobs a real run would
+                     do, each with a cost estimate from the length and sample rate
+                     of the flacs, and the totals of each kind.''')
+
+    p.add_option('-e', action='store', dest='plan', default=None, metavar='FILE',
+                 help='''Write the plan of the run (see -s) to FILE as json.  With -s
+                     only the totals are printed.''')
                      
     p.add_option('-u', action='store_true', dest='force_update', default=False,
                  help='''Force updating the tags on all files.''')
 
+    p.add_option('-j', action='store', dest='jobs', type='int', default=1,
+                 help='''Number of transcodes to run at once.  Tracks from the same
+                     album and from different albums are spread across the workers,
+                     longest first, so the run doesn't end on one long track.  Tags
+                     and art are written as each track finishes.''')
+
+    p.add_option('-l', action='store', dest='scan_threads', type='int', default=8,
+                 help='''Number of directories to list at once while scanning the flac
+                     and lossy trees, of flac folders to read the tags of ahead of
+                     the transcodes, and of output folders to update the tags and
+                     art of at once.  Raising this helps on high latency network
+                     mounts.  Defaults to %default.''')
+
+    p.add_option('-i', action='store_false', dest='use_manifest', default=True,
+                 help='''A manifest of synced tracks is kept in the lossy root, so that
+                     unchanged folders can be skipped after a single stat pass.
+                     Specifying -i ignores the manifest and rechecks every folder
+                     against the lossy tree.  The manifest is still updated.''')
+
+    p.add_option('-m', action='store', dest='report', default=None, metavar='FILE',
+                 help='''Write a report of where the run spent its time to FILE: wall
+                     and CPU time, bytes read and written and the realtime factor of
+                     the transcodes, for each stage (walk, check, load, replaygain,
+                     decode, encode, art, save) in total and per album.  The report
+                     is csv if FILE ends in .csv, and json otherwise.''')
+
+    p.add_option('-p', action='store_true', dest='progress', default=False,
+                 help='''Print a progress line with the throughput and an ETA to stderr
+                     as the flac tree is walked.''')
+
+    p.add_option('-w', action='store_true', dest='watch', default=False,
+                 help='''Keep running after the first pass, and sync each flac folder
+                     as it changes instead of walking the whole tree again.  Uses
+                     inotify if pyinotify is installed, otherwise the flac tree is
+                     listed again every debounce period (-d).  Stop with Ctrl-C.''')
+
+    p.add_option('-d', action='store', dest='debounce', type='float', default=10, metavar='SECONDS',
+                 help='''In watch mode, how long a folder has to go without changes
+                     before it is synced, so a rip or retag in progress is done in
+                     one go.  Defaults to %default.''')
+
+    p.add_option('-b', action='store_true', dest='background', default=False,
+                 help='''Background mode, for sharing the machine with other work.  The
+                     run, its decoders and encoders get a low CPU priority (nice 10)
+                     and the idle I/O class (ionice -c 3), and fewer than -j transcodes
+                     and replaygain scans are run at once while other processes keep
+                     the CPUs busy or free memory runs short.''')
+
+    p.add_option('-x', '--max-runtime', action='store', dest='max_runtime', type='float', default=None,
+                 metavar='SECONDS',
+                 help='''Stop starting new albums after SECONDS.  The transcodes already
+                     under way are finished and recorded, the purge keeps the output
+                     of the albums that were skipped, and the next run picks them up.''')
+
+    p.add_option('-q', action='store', dest='serve', default=None, metavar='HOST:PORT',
+                 help='''Coordinator mode.  Instead of transcoding here, serve the
+                     transcode jobs on HOST:PORT to workers started with -n, on
+                     machines that mount the flac and lossy trees at the same paths.
+                     Everything else (replaygain, tags, art, the manifest and the
+                     purge) is done here, and the run ends once the workers have
+                     finished every job.  The fused transcodes of -g stay local.
+                     The job server has no authentication, so bind it to localhost
+                     or an address on a trusted network only.''')
+
+    p.add_option('-n', action='store', dest='worker', default=None, metavar='HOST:PORT',
+                 help='''Worker mode.  Claim transcode jobs from the coordinator at
+                     HOST:PORT and run -j of them at once, until the coordinator
+                     stops.  A worker started first waits for the coordinator to
+                     come up.  No directories or format are given, they come with the
+                     jobs.  A job whose worker stops renewing its lease is handed to
+                     another worker after %d seconds.''' % job_lease)
+
     (opts, args) = p.parse_args()
-    if len(args) < 2:
-        p.error('At least two directory arguments are required,'
-                'the source flac dir and the root of the transcoded tree.')
-   
-    if opts.enc_ext not in ('m4a', 'ogg'):
-        p.error('Format must be m4a or ogg.  Aborting')
+    for dest in ('serve', 'worker'):
+        spec = getattr(opts, dest)
+        if spec is not None:
+            host, _, port = spec.rpartition(':')
+            if not port.isdigit():
+                p.error('Job server addresses are given as host:port.  Aborting')
+            setattr(opts, dest, (host or 'localhost', int(port)))
+
+    if opts.worker:
+        if opts.jobs < 1:
+            p.error('The number of jobs must be at least 1.')
+        return opts, args
+
+    if opts.targets:
+        if len(args) < 1:
+            p.error('At least one directory argument is required, the source flac dir.')
+
+        targets = []
+        for spec in opts.targets:
+            parts = spec.split(':', 2)
+            if len(parts) < 2 or not parts[1]:
+                p.error('Targets are given as format:lossyrootdir[:encopts].  Aborting')
+            if parts[0] not in encoders:
+                p.error('Format must be one of %s.  Aborting' % ', '.join(sorted(encoders)))
+            targets.append(Target(parts[0], parts[2] if len(parts) > 2 else '', parts[1]))
+
+        # The lossy files and manifest rows of a root are told apart by their extension only
+        roots = {}
+        for target in targets:
+            other = roots.setdefault((os.path.abspath(target.lossyroot), target.enc_ext), target)
+            if other is not target:
+                p.error('Targets %s and %s both write .%s files to %s.  Aborting'
+                        % (other.fmt, target.fmt, target.enc_ext, target.lossyroot))
+        opts.targets = targets
+
+    else:
+        if len(args) < 2:
+            p.error('At least two directory arguments are required,'
+                    'the source flac dir and the root of the transcoded tree.')
+
+        if opts.enc_ext not in encoders:
+            p.error('Format must be one of %s.  Aborting' % ', '.join(sorted(encoders)))
+
+        opts.targets = [Target(opts.enc_ext, opts.encopts, args[-1])]
+        args = args[0:-1]
+
+    if opts.jobs < 1:
+        p.error('The number of jobs must be at least 1.')
+
+    if opts.scan_threads < 1:
+        p.error('The number of scan threads must be at least 1.')
+
+    if opts.debounce <= 0:
+        p.error('The debounce time must be more than 0 seconds.')
+
+    if opts.max_runtime is not None and opts.max_runtime <= 0:
+        p.error('The runtime budget must be more than 0 seconds.')
       
     return opts, args
 
 
 def map_walk(f, path, *a, **k):
-    """maps a given function to each folder found in the supplied path.
+    """maps a given function to each folder found in the supplied path.  The tree is listed
+    concurrently by the tree scanner, which keeps the listings for the called function.
 
     :param function f: function to apply to each folder found
     :param path: root of path to walk
-    :param *a: additional path args, the flacroot and lossyroot
+    :param *a: additional path args, the flacroot
     :param **k: key/value dict to pass as named params to the called function
     """
-    # Passes in path args as *a (flacroot, lossyroot)
-    map(lambda (folder, subfolders, files): f(folder, files, *a, **k), os.walk(path))
+    # Passes in path args as *a (flacroot)
+    map(lambda (folder, subfolders, files): f(folder, files, *a, **k), _tree.walk(path))
+
+
+def flac_root_of(path, flacroots):
+    """ Finds the flac root a path is in.
+    :param str path: flac folder
+    :param list[str] flacroots: roots of the flac trees
+    :return str: the root, or None if the path isn't in any of them
+    """
+    path = os.path.normpath(path)
+    for flacroot in flacroots:
+        root = os.path.normpath(flacroot)
+        if path == root or path.startswith(os.path.join(root, '')):
+            return flacroot
+    return None
+
+
+def resume_jobs(flacroots, options, kwargs):
+    """ Finishes the transcodes an interrupted run had journaled, before anything else.  The
+        partial files they left are deleted, and their folders are synced again, which redoes
+        and journals again only the tracks whose lossy files never made it into place.
+    :param list[str] flacroots: roots of the flac trees
+    :param optparse.Values options: command line options
+    :param dict kwargs: named parameters for flacdir2lossydir
+    """
+    folders = set()
+    for target in options.targets:
+        if target.manifest is None:
+            continue
+        for thefolder, output in target.manifest.unfinished_jobs(target.enc_ext):
+            if os.path.exists(partial_name(output)):
+                os.remove(partial_name(output))
+            target.manifest.forget_jobs(thefolder, target.enc_ext)
+            folders.add(thefolder)
+    if not folders:
+        return
+
+    print_lines(sys.stdout, "Resuming unfinished transcodes in %d folders..." % len(folders))
+    for thefolder in sorted(folders):
+        flacroot = flac_root_of(thefolder, flacroots)
+        entries = _tree.listing(thefolder)
+        if flacroot is None or entries is None:
+            continue
+        flacdir2lossydir(thefolder, sorted(name for name, e in entries.items() if not e.is_dir), flacroot,
+                         **kwargs)
+
+    # The walk mustn't start these folders again while their transcodes are still running
+    wait_for_pool()
+    start_pool(options.jobs)
+
+
+def merged_expected(targets, lossyroot):
+    """ Merges the expected output files of the targets sharing a lossy root.
+    :param list[Target] targets: output targets
+    :param str lossyroot: root to merge the targets of
+    :return dict: output folder to the file names that belong in it, or None for all of them
+    """
+    expected = {}
+    for target in targets:
+        if target.lossyroot == lossyroot:
+            for outdir, names in target.expected.items():
+                if names is None or expected.get(outdir, set()) is None:
+                    expected[outdir] = None
+                else:
+                    expected.setdefault(outdir, set()).update(names)
+    return expected
+
+
+class InotifyWatcher(object):
+    """ Reports changes to the flac trees from inotify events.  New folders are watched as they
+        appear.
+    """
+
+    def __init__(self, flacroots):
+        """
+        :param list[str] flacroots: roots of the flac trees to watch
+        """
+        self.flacroots = flacroots
+        self.changed = []
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, self.event)
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        for flacroot in flacroots:
+            self.wm.add_watch(flacroot, mask, rec=True, auto_add=True, quiet=False)
+
+    def event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # Events were lost, so everything has to be checked again
+            self.changed.extend((flacroot, True) for flacroot in self.flacroots)
+        elif event.dir:
+            # A folder that arrived or left takes its whole tree with it
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                             pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO):
+                self.changed.append((event.pathname, True))
+        else:
+            self.changed.append((event.path, False))
+
+    def changes(self, timeout):
+        """ Waits for changes.
+        :param float timeout: longest time to wait, in seconds
+        :return list[tuple]: (folder, True if everything under it changed too) for each change
+        """
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed, self.changed = self.changed, []
+        return changed
+
+
+class PollWatcher(object):
+    """ Reports changes to the flac trees by listing them again every interval, for when
+        pyinotify isn't installed.  Listing the tree is only stat calls, so this is still
+        much cheaper than a full run.
+    """
+
+    def __init__(self, flacroots, interval):
+        """
+        :param list[str] flacroots: roots of the flac trees to watch
+        :param float interval: seconds between listings
+        """
+        self.flacroots = flacroots
+        self.interval = interval
+        self.snapshot = self.take()
+        self.last = time.time()
+
+    def take(self):
+        scan = TreeScan(_tree.threads)
+        return dict((folder, scan.cached(folder)) for flacroot in self.flacroots
+                    for folder, subfolders, files in scan.walk(flacroot))
+
+    def changes(self, timeout):
+        """ Waits for changes.  Parameters and return are as for InotifyWatcher.changes.
+        """
+        wait = self.last + self.interval - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.last = time.time()
+
+        snapshot = self.take()
+        changed = [(folder, False) for folder in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(folder) != self.snapshot.get(folder)]
+        self.snapshot = snapshot
+        return changed
+
+
+def start_watcher(flacroots, interval):
+    """ Starts watching the flac trees for changes, with inotify if pyinotify is installed.
+    :param list[str] flacroots: roots of the flac trees to watch
+    :param float interval: seconds between listings when polling
+    :return object: InotifyWatcher or PollWatcher
+    """
+    if pyinotify is not None:
+        return InotifyWatcher(flacroots)
+    print >> sys.stderr, "pyinotify is not installed, checking for changes every %g seconds" % interval
+    return PollWatcher(flacroots, interval)
+
+
+def sync_changes(changes, flacroots, options, kwargs):
+    """ Brings the lossy mirrors up to date with the flac folders that changed.  Folders that
+        still exist are processed as in a full run, and the outputs of folders that are gone
+        are purged.
+    :param list[tuple] changes: (folder, True if everything under it changed too)
+    :param list[str] flacroots: roots of the flac trees
+    :param optparse.Values options: command line options
+    :param dict kwargs: named parameters for flacdir2lossydir and dir_purge
+    """
+    targets = options.targets
+    for target in targets:
+        target.expected = {}
+        # The lossy trees may have been changed by hand since they were listed
+        _tree.forget_tree(target.lossyroot)
+    start_pool(options.jobs)
+    open_art_cache(options.art_cache, options.art_cache_size, options.simulate)
+    open_manifests(targets, options.simulate)
+
+    done = {}
+    gone = []
+    for path, tree in sorted(changes):
+        flacroot = flac_root_of(path, flacroots)
+        if flacroot is None:
+            continue
+
+        _tree.forget(os.path.dirname(path))
+        if tree:
+            _tree.forget_tree(path)
+        else:
+            _tree.forget(path)
+        if not _tree.isdir(path):
+            gone.append((path, flacroot))
+            continue
+
+        if tree:
+            folders = [(folder, files) for folder, subfolders, files in _tree.walk(path)]
+        else:
+            entries = _tree.listing(path) or {}
+            folders = [(path, sorted(name for name, e in entries.items() if not e.is_dir))]
+        for folder, files in folders:
+            if folder not in done:
+                done[folder] = flacroot
+                flacdir2lossydir(folder, files, flacroot, **kwargs)
+
+    wait_for_pool()
+    close_manifests(targets)
+    close_art_cache()
+
+    if options.purge_orphaned:
+        for lossyroot in sorted(set(target.lossyroot for target in targets)):
+            expected = merged_expected(targets, lossyroot)
+            outdirs = set(output_dir(target, folder, flacroot, options.force_ascii)
+                          for target in targets if target.lossyroot == lossyroot
+                          for folder, flacroot in done.items())
+            for outdir in sorted(outdirs):
+                # Only the folder itself, the folders under it are changes of their own
+                entries = _tree.listing(outdir)
+                if entries is not None:
+                    dir_purge(outdir, sorted(name for name, e in entries.items() if not e.is_dir), expected,
+                              **kwargs)
+                    _tree.forget(outdir)
+            for path, flacroot in gone:
+                for target in targets:
+                    if target.lossyroot == lossyroot:
+                        outdir = output_dir(target, path, flacroot, options.force_ascii)
+                        map_walk(dir_purge, outdir, expected, **kwargs)
+                        _tree.forget_tree(outdir)
+
+
+def watch(watcher, flacroots, options, kwargs):
+    """ Keeps the lossy mirrors in sync as the flac trees change, until interrupted or out of
+        runtime budget.  A folder is synced once it has had no changes for the debounce time,
+        so a rip or a retag is handled in one go rather than file by file.
+    :param object watcher: InotifyWatcher or PollWatcher, from start_watcher
+    :param list[str] flacroots: roots of the flac trees
+    :param optparse.Values options: command line options
+    :param dict kwargs: named parameters for flacdir2lossydir and dir_purge
+    """
+    print "Watching %s for changes..." % ', '.join(flacroots)
+    pending = {}
+    try:
+        while _governor is None or not _governor.out_of_time():
+            for path, tree in watcher.changes(1.0):
+                path = os.path.normpath(path)
+                pending[path] = (tree or pending.get(path, (False, 0))[0], time.time())
+
+            now = time.time()
+            ready = [(folder, whole) for folder, (whole, seen) in pending.items()
+                     if now - seen >= options.debounce]
+            if ready:
+                for folder, whole in ready:
+                    del pending[folder]
+                sync_changes(ready, flacroots, options, kwargs)
+    except KeyboardInterrupt:
+        pass
+
+
+class JobServer(object):
+    """ Hands out the transcode jobs of a coordinator run to workers over XML-RPC.  A claimed
+        job is leased to its worker, which renews the lease while it works, and the job of a
+        worker that stops renewing is handed out again.  The costliest jobs go first.  Lease tokens
+        are random, so only the worker a job was handed to can renew or finish it, but the server
+        has no other authentication and should only listen on localhost or a trusted network.
+    """
+
+    def __init__(self, address):
+        """
+        :param tuple address: (host, port) to listen on
+        """
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.jobs = {}
+        self.leases = {}
+        self.seq = itertools.count(1)
+        self.server = SimpleXMLRPCServer(address, logRequests=False, allow_none=True)
+        for f in (self.claim, self.renew, self.finish):
+            self.server.register_function(f)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, job, cost, done):
+        """ Queues a job for the workers.
+        :param dict job: what the worker needs to run the job, see publish_transcode
+        :param float cost: estimated cost of the job, see track_cost
+        :param function done: called with the list of outputs the worker put in place
+        """
+        with self.cond:
+            jid = next(self.seq)
+            self.jobs[jid] = {'job': job, 'cost': cost, 'done': done, 'token': None, 'worker': None,
+                              'deadline': None}
+            heapq.heappush(self.waiting, (-cost, jid))
+
+    def expire(self):
+        """ Takes back the jobs whose lease has run out.  Called with the lock held.
+        """
+        now = time.time()
+        for jid, entry in self.jobs.items():
+            if entry['deadline'] is not None and entry['deadline'] < now:
+                print_lines(sys.stderr, "Lost %s to worker %s, handing it out again..." % (
+                    entry['job']['source'], entry['worker']))
+                del self.leases[entry['token']]
+                entry['token'] = entry['worker'] = entry['deadline'] = None
+                heapq.heappush(self.waiting, (-entry['cost'], jid))
+
+    def lookup(self, token):
+        """ Finds the job a lease belongs to.  Called with the lock held.
+        :param str token: lease token given out with the job
+        :return dict: the job entry, or None if the lease is no longer held
+        """
+        jid = self.leases.get(token)
+        return None if jid is None else self.jobs[jid]
+
+    def claim(self, worker):
+        """ Leases the next job to a worker.
+        :param str worker: name of the worker, for messages
+        :return dict: the job with its lease token, empty if there's nothing to do right now
+        """
+        with self.cond:
+            self.expire()
+            if not self.waiting:
+                return {}
+            jid = heapq.heappop(self.waiting)[1]
+            entry = self.jobs[jid]
+            entry['token'] = os.urandom(16).encode('hex')
+            self.leases[entry['token']] = jid
+            entry['worker'] = worker
+            entry['deadline'] = time.time() + job_lease
+            return dict(entry['job'], token=entry['token'])
+
+    def renew(self, token):
+        """ Extends the lease on a job.
+        :param str token: lease token given out with the job
+        :return bool: False if the lease had already run out, and the job was handed out again
+        """
+        with self.cond:
+            entry = self.lookup(token)
+            if entry is None:
+                return False
+            entry['deadline'] = time.time() + job_lease
+            return True
+
+    def finish(self, token, placed):
+        """ Takes the result of a job from its worker.
+        :param str token: lease token given out with the job
+        :param list[str] placed: the output files the worker put in place
+        :return bool: False if the lease had already run out, and the result was ignored
+        """
+        with self.cond:
+            entry = self.lookup(token)
+            if entry is None:
+                return False
+            entry['deadline'] = None
+        try:
+            entry['done'](placed)
+        finally:
+            with self.cond:
+                del self.jobs[self.leases.pop(token)]
+                self.cond.notify_all()
+        return True
+
+    def wait(self):
+        """ Waits for the workers to finish every job published so far.
+        """
+        with self.cond:
+            while self.jobs:
+                self.expire()
+                self.cond.wait(1.0)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_job_server(address):
+    """ Starts serving transcode jobs to workers, for a coordinator run.
+    :param tuple address: (host, port) to listen on, or None to transcode here
+    """
+    global _jobserver
+    if address is not None:
+        _jobserver = JobServer(address)
+        print "Serving transcode jobs on %s:%d..." % address
+
+
+def stop_job_server():
+    """ Stops serving transcode jobs.
+    """
+    global _jobserver
+    if _jobserver is not None:
+        _jobserver.close()
+    _jobserver = None
+
+
+def publish_transcode(ft, outputs, flacart, art_hash, thefolder, cost):
+    """ Hands the transcode of a track to the workers.  The workers see the flac and lossy
+        trees at the same paths, and everything but the transcode and tagging of the new
+        lossy files, the manifest included, stays with the coordinator.
+    :param FlacTrack ft: flac file to transcode, with the tags to give the lossy files
+    :param list[tuple] outputs: (Target, output filename with path) for each lossy file to write
+    :param str flacart: folder.jpg to embed, or None
+    :param str art_hash: hash of the source art
+    :param str thefolder: flac folder
+    :param float cost: estimated cost of the transcode
+    """
+    job = {'folder': thefolder, 'source': ft.filename, 'tags': ft.tags, 'flacart': flacart, 'art_hash': art_hash,
+           'outputs': [[target.fmt, target.encopts, target.lossyroot, newname] for target, newname in outputs]}
+
+    def done(placed):
+        for target, newname in outputs:
+            if newname in placed:
+                record_output(ft, target, newname, art_hash if flacart else None, thefolder)
+            elif target.manifest is not None:
+                target.manifest.finish_job(ft.filename, target.enc_ext)
+        print_progress(thefolder, ft.tracknumber)
+
+    _jobserver.publish(job, cost, done)
+
+
+def wire_path(path):
+    """ Gets a path back from XML-RPC, which turns non-ascii strings into unicode.
+    :param basestring path: path from a job
+    :return str: the path as a utf-8 byte string, or None
+    """
+    return path.encode('utf-8') if isinstance(path, unicode) else path
+
+
+def run_remote_job(job, lease):
+    """ Runs a transcode job from the coordinator.
+    :param dict job: job from JobServer.claim
+    :param Lease lease: lease on the job
+    :return list[str]: the output files that are now in place
+    """
+    thefolder = wire_path(job['folder'])
+    ft = read_flac(wire_path(job['source']))
+    ft.tags = dict((str(k), [unicode(v) for v in values]) for k, values in job['tags'].items())
+    outputs = [(Target(fmt, encopts, wire_path(lossyroot)), wire_path(newname))
+               for fmt, encopts, lossyroot, newname in job['outputs']]
+    flacart = wire_path(job['flacart'])
+    art = make_folder_art(flacart, job['art_hash']) if flacart else None
+    placed = transcode_track(ft, outputs, art, job['art_hash'], thefolder, ft.tracknumber, lease)
+    return [newname for target, newname in placed]
+
+
+class Lease(object):
+    """ A worker's hold on a job from the coordinator.  Once it is lost the job may already be
+        running on another worker, so the transcode is stopped and nothing of it is placed.
+    """
+
+    def __init__(self, token):
+        """
+        :param str token: lease token given out with the job
+        """
+        self.token = token
+        self.lost = threading.Event()
+
+
+def keep_lease(address, lease, stop):
+    """ Renews the lease on a job until told to stop, or until the coordinator refuses.
+    :param tuple address: (host, port) of the coordinator
+    :param Lease lease: lease on the job, marked lost if the coordinator refuses to renew it
+    :param threading.Event stop: set when the job is done
+    """
+    server = xmlrpclib.ServerProxy('http://%s:%d/' % address, allow_none=True)
+    while not stop.wait(job_lease / 4.0):
+        try:
+            if not server.renew(lease.token):
+                lease.lost.set()
+                print_lines(sys.stderr, "Lost the lease on job %s, abandoning it" % lease.token)
+                return
+        except rpc_errors:
+            pass
+
+
+def work_jobs(address, worker):
+    """ Claims and runs jobs from the coordinator until it goes away.  A coordinator that
+        can't be reached yet is waited for, with a growing delay between the attempts.
+    :param tuple address: (host, port) of the coordinator
+    :param str worker: name of this worker, for the coordinator's messages
+    """
+    server = xmlrpclib.ServerProxy('http://%s:%d/' % address, allow_none=True)
+    connected = False
+    delay = 1
+    while True:
+        if _governor is not None and _governor.out_of_time():
+            return
+        try:
+            job = server.claim(worker)
+        except rpc_errors:
+            if connected:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, connect_backoff)
+            continue
+        connected = True
+        if not job:
+            time.sleep(1)
+            continue
+
+        lease = Lease(job['token'])
+        stop = threading.Event()
+        renewer = threading.Thread(target=keep_lease, args=(address, lease, stop))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            placed = run_remote_job(job, lease)
+        except Exception as e:
+            print_lines(sys.stderr, "Unexpected failure in transcode job: %s" % e)
+            placed = []
+        finally:
+            stop.set()
+            renewer.join()
+        try:
+            server.finish(job['token'], placed)
+        except rpc_errors:
+            return
+
+
+def run_worker(address, jobs):
+    """ Runs transcode jobs for a coordinator, until it stops serving them.  With more than
+        one job at once, each worker pool thread claims jobs of its own.
+    :param tuple address: (host, port) of the coordinator
+    :param int jobs: number of jobs to run at once
+    """
+    print "Working for the coordinator at %s:%d..." % address
+    name = '%s-%d' % (socket.gethostname(), os.getpid())
+    start_pool(jobs)
+    try:
+        if _pool is None:
+            work_jobs(address, name)
+        else:
+            loops = [_pool.apply_async(work_jobs, (address, '%s-%d' % (name, i))) for i in range(jobs)]
+            while not all(loop.ready() for loop in loops):
+                time.sleep(1)
+    except KeyboardInterrupt:
+        return
+    wait_for_pool()
+    if _governor is not None and _governor.out_of_time():
+        print "Runtime budget used up, stopping."
+    else:
+        print "The coordinator at %s:%d has gone, stopping." % address
 
 
 def main():
@@ -502,14 +3498,72 @@ def main():
     # get command line options
     options, args = get_options()
 
+    # The targets replace the single format/encopts/lossyroot
+    kwargs = dict(options.__dict__)
+    del kwargs['enc_ext'], kwargs['encopts'], kwargs['art_cache'], kwargs['art_cache_size']
+    del kwargs['scan_threads'], kwargs['report'], kwargs['progress'], kwargs['watch'], kwargs['debounce']
+    del kwargs['plan'], kwargs['serve'], kwargs['worker'], kwargs['background'], kwargs['max_runtime']
+    del kwargs['jobs']
+
+    # Before any threads are started, so they inherit the lower priority
+    start_governor(options.jobs, options.background, options.max_runtime)
+
+    if options.worker:
+        start_stats(options.report, options.progress)
+        open_art_cache(options.art_cache, options.art_cache_size, False)
+        run_worker(options.worker, options.jobs)
+        close_art_cache()
+        close_governor()
+        close_stats()
+        return
+
+    start_stats(options.report, options.progress)
+    start_plan(options.plan, options.simulate)
+    start_scanner(options.scan_threads)
+    start_pool(options.jobs)
+    start_tag_pool(options.scan_threads)
+    start_reader(options.scan_threads)
+    start_job_server(options.serve)
+    open_art_cache(options.art_cache, options.art_cache_size, options.simulate)
+
+    # Changes made during the first pass are picked up by the watch that follows it
+    watcher = None
+    if options.watch:
+        watcher = start_watcher(args, options.debounce)
+
     # call map_walk
-    lossyroot = args[-1]
-    for flacroot in args[0:-1]:
-        modargs = [flacroot, lossyroot]
-        map_walk(flacdir2lossydir, flacroot, *modargs, **options.__dict__)
+    open_manifests(options.targets, options.simulate)
+    if not options.simulate:
+        resume_jobs(args, options, kwargs)
+    for flacroot in args:
+        if _stats is not None:
+            _stats.expect(flacroot)
+        if _reader is not None:
+            for folder, subfolders, files in _reader.walk(flacroot, flacroot, **kwargs):
+                flacdir2lossydir(folder, files, flacroot, **kwargs)
+        else:
+            map_walk(flacdir2lossydir, flacroot, flacroot, **kwargs)
+    close_reader()
+
+    # Let the outstanding transcodes finish before purging
+    wait_for_pool()
+    close_manifests(options.targets)
+    close_art_cache()
 
     if options.purge_orphaned:
-        map_walk(dir_purge, lossyroot, *args, **options.__dict__)
+        for lossyroot in sorted(set(target.lossyroot for target in options.targets)):
+            # Targets sharing a root share its folders
+            map_walk(dir_purge, lossyroot, merged_expected(options.targets, lossyroot), **kwargs)
+
+    # Watch mode syncs are not part of the plan
+    close_plan(options.simulate)
+
+    if watcher is not None:
+        watch(watcher, args, options, kwargs)
+
+    stop_job_server()
+    close_governor()
+    close_stats()
     
 if __name__ == '__main__':
     main()
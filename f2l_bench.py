@@ -0,0 +1,506 @@
+#!/usr/bin/python
+
+"""Benchmark for f2l.py.
+
+Generates a synthetic flac library, then times f2l.py over a fixed set of scenarios:
+a cold full mirror, a no-op rescan, a tag-only update, an art-only update, a purge, a
+rescan with the sync manifest rebuilt and the rename of an album.  The rename has to be
+planned as moves of the album's lossy files, which is checked.
+The encoders are replaced by stubs that consume the decoded audio and write a minimal,
+taggable lossy file, so the numbers measure the sync itself rather than the encoder.
+flac and metaflac are stubbed too when they aren't installed.  Results are written as
+JSON.
+"""
+
+# option parser
+import optparse
+
+# system command functionality
+from subprocess import call
+
+# metadata read & write
+import mutagen
+from mutagen.flac import FLAC
+
+# image generation
+from PIL import Image
+
+# the formats f2l.py supports, and its sync manifest
+from f2l import encoders, manifest_name
+
+# standard libs
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import hashlib
+import resource
+import tempfile
+from array import array
+from distutils.spawn import find_executable
+
+f2l_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'f2l.py')
+encoder_tools = ('wine', 'neroAacEnc', 'oggenc', 'opusenc', 'fdkaac', 'ffmpeg')
+
+blocksize = 4096
+flac_rate_codes = {44100: 9, 48000: 10}
+art_sizes = (300, 600, 1000, 1500)
+genres = [u'Rock', u'Jazz', u'Classical', u'Electronic', u'Folk']
+
+
+def _crc_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for i in range(256):
+        crc = i << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & mask if crc & top else (crc << 1) & mask
+        table.append(crc)
+    return table
+
+
+crc8_table = _crc_table(0x07, 8)
+crc16_table = _crc_table(0x8005, 16)
+
+
+def crc8(data):
+    crc = 0
+    for c in bytearray(data):
+        crc = crc8_table[crc ^ c]
+    return crc
+
+
+def crc16(data):
+    crc = 0
+    for c in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ crc16_table[(crc >> 8) ^ c]
+    return crc
+
+
+def utf8_number(n):
+    """ Codes a frame number the way flac frame headers do.
+    :param int n: frame number
+    :return str: coded bytes
+    """
+    if n < 0x80:
+        return chr(n)
+    nbytes = 2
+    while n >= 1 << (5 * nbytes + 1):
+        nbytes += 1
+    out = [0x80 | ((n >> (6 * i)) & 0x3f) for i in range(nbytes - 1)]
+    lead = ((0xff << (8 - nbytes)) & 0xff) | (n >> (6 * (nbytes - 1)))
+    return ''.join(chr(c) for c in [lead] + out[::-1])
+
+
+def write_flac(path, samples, rate, tags):
+    """ Writes a valid 16 bit stereo flac file using verbatim subframes, so it can be made
+        without an encoder but still decoded by the real flac tools.
+    :param str path: file to write
+    :param array samples: interleaved stereo 16 bit samples
+    :param int rate: sample rate, 44100 or 48000
+    :param dict tags: vorbis comments to set
+    """
+    total = len(samples) // 2
+    pcm = array('h', samples)
+    if sys.byteorder != 'little':
+        pcm.byteswap()
+    md5 = hashlib.md5(pcm.tostring()).digest()
+
+    streaminfo = struct.pack('>HH', blocksize, blocksize) + '\x00' * 6
+    streaminfo += struct.pack('>Q', (rate << 44) | (1 << 41) | (15 << 36) | total) + md5
+    vendor = 'f2l_bench'
+    comment = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0)
+
+    with open(path, 'wb') as f:
+        f.write('fLaC')
+        f.write(struct.pack('>I', len(streaminfo))[1:].rjust(4, '\x00'))
+        f.write(streaminfo)
+        f.write(chr(0x84) + struct.pack('>I', len(comment))[1:])
+        f.write(comment)
+
+        for frame, start in enumerate(range(0, total, blocksize)):
+            n = min(blocksize, total - start)
+            header = '\xff\xf8'
+            if n == blocksize:
+                header += chr((12 << 4) | flac_rate_codes[rate]) + chr(0x18) + utf8_number(frame)
+            else:
+                header += chr((7 << 4) | flac_rate_codes[rate]) + chr(0x18) + utf8_number(frame)
+                header += struct.pack('>H', n - 1)
+            header += chr(crc8(header))
+
+            body = header
+            for channel in (0, 1):
+                sub = array('h', samples[2 * start + channel:2 * (start + n):2])
+                if sys.byteorder == 'little':
+                    sub.byteswap()
+                body += '\x02' + sub.tostring()
+            f.write(body + struct.pack('>H', crc16(body)))
+
+    ft = FLAC(path)
+    ft.update(tags)
+    ft.save()
+
+
+def make_art(path, size, rnd):
+    """ Writes a noisy folder.jpg, so the jpeg is about as big as real cover art.
+    :param str path: file to write
+    :param int size: width and height in pixels
+    :param random.Random rnd: random source
+    """
+    tile = Image.frombytes('RGB', (64, 64), ''.join(chr(rnd.randrange(256)) for _ in range(64 * 64 * 3)))
+    im = tile.resize((size, size), Image.BILINEAR)
+    im.save(path, "JPEG", quality=90)
+
+
+def make_library(root, albums, tracks, seconds, seed):
+    """ Generates the synthetic flac library.  Every third album is missing replaygain, and
+        the cover art cycles through several sizes.
+    :param str root: directory to create the library in
+    :param int albums: number of albums
+    :param int tracks: number of tracks per album
+    :param float seconds: length of each track
+    :param int seed: random seed, so libraries are repeatable
+    """
+    rnd = random.Random(seed)
+    for a in range(albums):
+        artist = u'Artist %03d' % (a // 3)
+        album = u'Album %03d' % a
+        folder = os.path.join(root, artist, album)
+        os.makedirs(folder)
+        rate = 48000 if a % 5 == 4 else 44100
+        for t in range(1, tracks + 1):
+            nsamples = int(seconds * rate) + rnd.randrange(rate // 10)
+            samples = array('h', (rnd.randrange(-2000, 2000) for _ in range(2 * nsamples)))
+            tags = {'title': u'Track %d' % t, 'artist': artist, 'album': album,
+                    'tracknumber': u'%d' % t, 'date': u'%d' % (1970 + a % 50),
+                    'genre': genres[a % len(genres)]}
+            if a % 3:
+                tags.update({'replaygain_track_gain': u'-3.10 dB', 'replaygain_track_peak': u'0.06100000',
+                             'replaygain_album_gain': u'-3.10 dB', 'replaygain_album_peak': u'0.06100000',
+                             'replaygain_reference_loudness': u'89.0 dB'})
+            write_flac(os.path.join(folder, u'%02d - Track %d.flac' % (t, t)), samples, rate, tags)
+        make_art(os.path.join(folder, 'folder.jpg'), art_sizes[a % len(art_sizes)], rnd)
+
+
+def album_folders(root):
+    return sorted(folder for folder, subfolders, files in os.walk(root)
+                  if any(f.endswith('.flac') for f in files))
+
+
+def retag(root, fraction, rnd):
+    """ Changes the genre of a fraction of the albums.
+    """
+    folders = album_folders(root)
+    for folder in rnd.sample(folders, max(1, int(len(folders) * fraction))):
+        for f in sorted(os.listdir(folder)):
+            if f.endswith('.flac'):
+                ft = FLAC(os.path.join(folder, f))
+                ft['genre'] = u'Retagged'
+                ft.save()
+
+
+def reart(root, fraction, rnd):
+    """ Replaces the cover art of a fraction of the albums.
+    """
+    folders = album_folders(root)
+    for folder in rnd.sample(folders, max(1, int(len(folders) * fraction))):
+        make_art(os.path.join(folder, 'folder.jpg'), rnd.choice(art_sizes), rnd)
+
+
+def remove_some(root, fraction, rnd):
+    """ Deletes a fraction of the albums, and one track from as many others.
+    """
+    folders = album_folders(root)
+    picked = rnd.sample(folders, min(len(folders), 2 * max(1, int(len(folders) * fraction))))
+    half = len(picked) // 2
+    for folder in picked[:half]:
+        shutil.rmtree(folder)
+    for folder in picked[half:]:
+        flacs = sorted(f for f in os.listdir(folder) if f.endswith('.flac'))
+        os.remove(os.path.join(folder, flacs[-1]))
+
+
+def rename_album(root, rnd):
+    """ Renames one of the albums, as adding ' (Deluxe)' to its name.
+    :return int: number of tracks in the album
+    """
+    folder = rnd.choice(album_folders(root))
+    os.rename(folder, folder + ' (Deluxe)')
+    return len([f for f in os.listdir(folder + ' (Deluxe)') if f.endswith('.flac')])
+
+
+def ogg_stub(path, rate, nsamples, opus=False):
+    """ Writes a minimal Ogg Vorbis or Opus file that mutagen can read and tag.
+    """
+    from mutagen.ogg import OggPage
+    if opus:
+        headers = ['OpusHead' + struct.pack('<BBHIhB', 1, 2, 312, rate, 0, 0),
+                   'OpusTags' + struct.pack('<I', 4) + 'stub' + struct.pack('<I', 0)]
+        nsamples = nsamples * 48000 // rate + 312
+    else:
+        headers = ['\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, rate, 0, 128000, 0, 0xb8, 1),
+                   '\x03vorbis' + struct.pack('<I', 4) + 'stub' + struct.pack('<I', 0) + '\x01',
+                   '\x05vorbis' + '\x00' * 8]
+    pages = []
+    for seq, (packets, position) in enumerate([(headers[:1], 0), (headers[1:], 0), (['\x00' * 16], nsamples)]):
+        page = OggPage()
+        page.packets = packets
+        page.serial = 1
+        page.sequence = seq
+        page.position = position
+        page.first = seq == 0
+        page.last = seq == 2
+        pages.append(page.write())
+    with open(path, 'wb') as f:
+        f.write(''.join(pages))
+
+
+def mp4_stub(path, rate, nsamples):
+    """ Writes a minimal MP4 file that mutagen can read and tag.
+    """
+    def atom(name, data):
+        return struct.pack('>I', 8 + len(data)) + name + data
+
+    mvhd = struct.pack('>B3xIIII', 0, 0, 0, rate, nsamples) + struct.pack('>IH10x', 0x10000, 0x100)
+    mvhd += struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000) + '\x00' * 24
+    mvhd += struct.pack('>I', 2)
+    with open(path, 'wb') as f:
+        f.write(atom('ftyp', 'M4A \x00\x00\x00\x00M4A mp42isom'))
+        f.write(atom('moov', atom('mvhd', mvhd)))
+        f.write(atom('mdat', '\x00' * 16))
+
+
+def read_wav(stream):
+    """ Reads a WAV stream to the end.
+    :return tuple: (sample rate, number of frames)
+    """
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != 'RIFF' or header[8:12] != 'WAVE':
+        raise IOError("Encoder input is not a WAV stream")
+    rate, framesize = 44100, 4
+    while True:
+        chunkhead = stream.read(8)
+        if len(chunkhead) < 8:
+            return rate, 0
+        chunkid, size = struct.unpack('<4sI', chunkhead)
+        if chunkid == 'data':
+            break
+        body = stream.read(size + size % 2)
+        if chunkid == 'fmt ':
+            channels, rate = struct.unpack('<HI', body[2:8])
+            framesize = channels * struct.unpack('<H', body[14:16])[0] // 8
+    total = 0
+    while True:
+        chunk = stream.read(1 << 16)
+        if not chunk:
+            break
+        total += len(chunk)
+    return rate, total // framesize
+
+
+def stub_tool(tool, args):
+    """ Stands in for the external tools f2l.py runs.
+    :param str tool: one of the encoders (wine for oggenc2.exe), 'flac' or 'metaflac'
+    :param list[str] args: the tool's command line
+    """
+    if tool in ('wine', 'oggenc'):
+        rate, nsamples = read_wav(sys.stdin)
+        ogg_stub(args[args.index('-o') + 1], rate, nsamples)
+
+    elif tool == 'opusenc':
+        rate, nsamples = read_wav(sys.stdin)
+        ogg_stub(args[-1], rate, nsamples, opus=True)
+
+    elif tool == 'neroAacEnc':
+        rate, nsamples = read_wav(sys.stdin)
+        mp4_stub(args[args.index('-of') + 1], rate, nsamples)
+
+    elif tool in ('fdkaac', 'ffmpeg'):
+        rate, nsamples = read_wav(sys.stdin)
+        mp4_stub(args[args.index('-o') + 1] if tool == 'fdkaac' else args[-1], rate, nsamples)
+
+    elif tool == 'flac':
+        # Only decoding to stdout is needed: flac --silent -d -c file
+        ft = FLAC(args[-1])
+        rate = ft.info.sample_rate
+        nsamples = ft.info.total_samples
+        out = sys.stdout
+        out.write('RIFF' + struct.pack('<I', 36 + 4 * nsamples) + 'WAVE')
+        out.write('fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, rate, 4 * rate, 4, 16))
+        out.write('data' + struct.pack('<I', 4 * nsamples))
+        block = '\x10\x00\xf0\xff' * blocksize
+        while nsamples > 0:
+            n = min(nsamples, blocksize)
+            out.write(block[:4 * n])
+            nsamples -= n
+
+    elif tool == 'metaflac':
+        # Only metaflac --add-replay-gain files... is needed
+        for path in args[1:]:
+            ft = FLAC(path)
+            ft.update({'replaygain_track_gain': u'-3.10 dB', 'replaygain_track_peak': u'0.06100000',
+                       'replaygain_album_gain': u'-3.10 dB', 'replaygain_album_peak': u'0.06100000',
+                       'replaygain_reference_loudness': u'89.0 dB'})
+            ft.save()
+
+
+def make_stub_bin(bindir):
+    """ Creates the stub tools, returning which of flac/metaflac are stubbed.
+    :param str bindir: directory to put the stubs in, which goes first on the PATH
+    :return list[str]: names of the stubbed tools
+    """
+    stubs = list(encoder_tools) + [tool for tool in ('flac', 'metaflac') if not find_executable(tool)]
+    os.makedirs(bindir)
+    for tool in stubs:
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" --stub %s "$@"\n' % (sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, 0o755)
+    return stubs
+
+
+def run_f2l(args, env):
+    """ Runs f2l.py once.
+    :return dict: wall and cpu times, and the return code
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        retcode = call([sys.executable, f2l_script] + args, env=env, stdout=devnull)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'wall': round(wall, 4),
+            'cpu_user': round(after.ru_utime - before.ru_utime, 4),
+            'cpu_sys': round(after.ru_stime - before.ru_stime, 4),
+            'returncode': retcode}
+
+
+def get_options():
+    p = optparse.OptionParser(usage="usage: %prog [options]",
+                              description='''Times f2l.py over a synthetic flac library with stub
+                                             encoders, and writes the results as JSON.''')
+
+    p.add_option('-n', action='store', dest='albums', type='int', default=20,
+                 help='Number of albums to generate.  Defaults to %default.')
+
+    p.add_option('-m', action='store', dest='tracks', type='int', default=10,
+                 help='Number of tracks per album.  Defaults to %default.')
+
+    p.add_option('-l', action='store', dest='seconds', type='float', default=2.0,
+                 help='Length of each track in seconds.  Defaults to %default.')
+
+    p.add_option('-r', action='store', dest='seed', type='int', default=1,
+                 help='Random seed for the library and the scenarios.  Defaults to %default.')
+
+    p.add_option('-p', action='store', dest='fraction', type='float', default=0.1,
+                 help='''Fraction of the albums changed by the tag, art and purge
+                     scenarios.  Defaults to %default.''')
+
+    p.add_option('-f', action='store', dest='enc_ext', default='ogg',
+                 help='Lossy format to mirror to, as for f2l.py -f.  Defaults to %default.')
+
+    p.add_option('-a', action='store', dest='f2l_args', default='',
+                 help='Extra arguments for f2l.py, e.g. "-j 4".')
+
+    p.add_option('-w', action='store', dest='workdir', default=None,
+                 help='''Directory to work in.  Defaults to a temporary directory,
+                     which is removed afterwards.''')
+
+    p.add_option('-o', action='store', dest='output', default=None,
+                 help='File to write the JSON results to.  Defaults to stdout.')
+
+    (opts, args) = p.parse_args()
+    if opts.enc_ext not in encoders:
+        p.error('Format must be one of %s.  Aborting' % ', '.join(sorted(encoders)))
+
+    return opts, args
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--stub':
+        stub_tool(sys.argv[2], sys.argv[3:])
+        return
+
+    options, args = get_options()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='f2l_bench')
+    flacroot = os.path.join(workdir, 'flac')
+    lossyroot = os.path.join(workdir, options.enc_ext)
+    stubbed = make_stub_bin(os.path.join(workdir, 'bin'))
+    env = dict(os.environ, PATH=os.path.join(workdir, 'bin') + os.pathsep + os.environ.get('PATH', ''))
+    f2l_args = ['-c', os.path.join(workdir, 'cache'), '-f', options.enc_ext] + options.f2l_args.split()
+    f2l_args += [flacroot, lossyroot]
+
+    rnd = random.Random(options.seed)
+    results = []
+    try:
+        start = time.time()
+        make_library(flacroot, options.albums, options.tracks, options.seconds, options.seed)
+        generate = round(time.time() - start, 4)
+
+        scenarios = [('cold', None),
+                     ('noop', None),
+                     ('tags', retag),
+                     ('art', reart),
+                     ('purge', remove_some)]
+        for name, change in scenarios:
+            if change:
+                change(flacroot, options.fraction, rnd)
+            result = run_f2l(f2l_args, env)
+            result['scenario'] = name
+            results.append(result)
+            print >> sys.stderr, "%-6s %8.3fs" % (name, result['wall'])
+
+        # The manifest is rebuilt from the mirror as after a version change, and has to know
+        # the lossy files well enough for a renamed album to be moved rather than transcoded
+        os.remove(os.path.join(lossyroot, manifest_name))
+        result = run_f2l(f2l_args, env)
+        result['scenario'] = 'rebuild'
+        results.append(result)
+        print >> sys.stderr, "%-6s %8.3fs" % ('rebuild', result['wall'])
+
+        renamed = rename_album(flacroot, rnd)
+        planfile = os.path.join(workdir, 'plan.json')
+        run_f2l(['-s', '-e', planfile] + f2l_args, env)
+        with open(planfile) as f:
+            totals = json.load(f)['totals']
+        result = run_f2l(f2l_args, env)
+        result['scenario'] = 'rename'
+        result['relocated'] = totals.get('relocate', {}).get('jobs', 0)
+        result['transcoded'] = totals.get('transcode', {}).get('jobs', 0)
+        results.append(result)
+        print >> sys.stderr, "%-6s %8.3fs" % ('rename', result['wall'])
+        relocated = result['relocated'] == renamed and result['transcoded'] == 0
+        if not relocated:
+            print >> sys.stderr, "The renamed album's %d tracks were planned as %d moves and %d transcodes" % \
+                (renamed, result['relocated'], result['transcoded'])
+
+        report = {'params': {'albums': options.albums, 'tracks': options.tracks, 'seconds': options.seconds,
+                             'seed': options.seed, 'fraction': options.fraction, 'format': options.enc_ext,
+                             'f2l_args': options.f2l_args},
+                  'python': sys.version.split()[0],
+                  'mutagen': mutagen.version_string,
+                  'stubs': stubbed,
+                  'generate': generate,
+                  'results': results}
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if not relocated:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()